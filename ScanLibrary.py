@@ -28,6 +28,7 @@
 
 
 
+import bisect
 import json
 import os
 import stat
@@ -36,28 +37,157 @@ import time
 
 import fileSource
 import fileDestination
+import libraryIndex
 import trackHistory
+import workerPool
 
 
 kLastModified = "__mtime"
+kRecentExtension = ".recent"
 kTrackAttributes = "artist,trackArtist,album,title,trackNum,year,discNumber,genre,bitrate,duration".split(',')
 
 class NoFilenameError(Exception):
    pass
 
 
+def Names(d):
+   ''' return a list of the keys in a library dict that aren't for our internal
+      use.
+   >>> Names({'__mtime': 0, 'b': {}, 'a': {}})
+   ['a', 'b']
+   '''
+   return sorted(k for k in d if not k.startswith("__"))
+
+
+def ReadTrack(path):
+   ''' Read the metadata of a single track; returns a dict of track details.'''
+   mp3 = fileDestination.Mp3File(path)
+   return dict((attr, getattr(mp3, attr)) for attr in kTrackAttributes)
+
+
+class ScanReport(object):
+   ''' Lists of the tracks (as 'artist/album/track' paths) that a scan found
+      to have been added, changed, or removed. 
+   '''
+   def __init__(self):
+      self.added = []
+      self.changed = []
+      self.removed = []
+
+   def __str__(self):
+      return "{0} added, {1} changed, {2} removed".format(len(self.added), 
+         len(self.changed), len(self.removed))
+
+
+def RecentPath(filePath):
+   ''' the Recent index for a library file is stored next to it.
+   >>> RecentPath('library.json')
+   'library.json.recent'
+   '''
+   return filePath + kRecentExtension
+
+
 class Recent(object):
    def __init__(self):
-      pass
+      ''' A time-ordered index of when every track in the library was 
+         acquired, so we can find the tracks added in the last N days with a 
+         binary search instead of looking through the whole library.
+
+      >>> r = Recent()
+      >>> r.AddRecent(u'Kneebody', u'2008_Low', u'01_A.mp3', 300)
+      >>> r.AddRecent(u'Kneebody', u'2008_Low', u'02_B.mp3', 100)
+      >>> r.AddRecent(u'Beatles', u'1965_Rubber-Soul', u'01_C.mp3', 200)
+      >>> r.TrackPaths(200)
+      [u'Beatles/1965_Rubber-Soul/01_C.mp3', u'Kneebody/2008_Low/01_A.mp3']
+      >>> r.AddRecent(u'Kneebody', u'2008_Low', u'01_A.mp3', 50)
+      >>> r.TrackPaths(200)
+      [u'Beatles/1965_Rubber-Soul/01_C.mp3']
+      >>> r.RemoveTracks(u'Beatles', u'1965_Rubber-Soul', [u'01_C'])
+      >>> r.TrackPaths(0)
+      [u'Kneebody/2008_Low/01_A.mp3', u'Kneebody/2008_Low/02_B.mp3']
+      '''
+      # sorted list of (acquired, artist, album, trackFile) tuples
+      self.entries = []
+      # {(artist, album) : {trackFile: acquired}}
+      self.albums = {}
+      self.filePath = None
+
+   def _Remove(self, entry):
+      i = bisect.bisect_left(self.entries, entry)
+      if i < len(self.entries) and self.entries[i] == entry:
+         del self.entries[i]
 
    def AddRecent(self, artistDir, albumDir, trackFile, timeStamp):
-      pass
+      ''' add (or update the timestamp of) a track. '''
+      album = self.albums.setdefault((artistDir, albumDir), {})
+      oldTimeStamp = album.get(trackFile)
+      if oldTimeStamp == timeStamp:
+         return
+      if oldTimeStamp is not None:
+         self._Remove((oldTimeStamp, artistDir, albumDir, trackFile))
+      album[trackFile] = timeStamp
+      bisect.insort(self.entries, (timeStamp, artistDir, albumDir, trackFile))
+
+   def RemoveTracks(self, artistDir, albumDir, trackNames=None):
+      ''' Remove tracks from an album (or all of them if trackNames is None). 
+         trackNames are the names used in the library, without the file 
+         extension.
+      '''
+      album = self.albums.get((artistDir, albumDir), {})
+      for (trackFile, timeStamp) in album.items():
+         if trackNames is None or os.path.splitext(trackFile)[0] in trackNames:
+            self._Remove((timeStamp, artistDir, albumDir, trackFile))
+            del album[trackFile]
+      if not album:
+         self.albums.pop((artistDir, albumDir), None)
+
+   def Since(self, timeStamp):
+      ''' return the list of (acquired, artist, album, trackFile) entries for 
+         the tracks acquired at or after `timeStamp`, oldest first.
+      '''
+      i = bisect.bisect_left(self.entries, (timeStamp,))
+      return self.entries[i:]
+
+   def TrackPaths(self, timeStamp):
+      ''' return a sorted list of the 'artist/album/trackFile' paths of the 
+         tracks acquired at or after `timeStamp`.
+      '''
+      return sorted(os.path.join(artist, album, track) 
+         for (acquired, artist, album, track) in self.Since(timeStamp))
+
+   def Rebuild(self, library):
+      ''' recreate the index from a library dict (e.g. if we have a library 
+         file that was written before we kept a Recent index alongside it.)
+      '''
+      self.entries = []
+      self.albums = {}
+      for artistName in Names(library):
+         for albumName in Names(library[artistName]):
+            album = library[artistName][albumName]
+            for trackName in Names(album):
+               acquired = album[trackName].get('acquired')
+               if acquired:
+                  self.AddRecent(artistName, albumName, trackName + u".mp3", 
+                     acquired)
 
    def LoadFile(self, filePath):
-      pass
+      self.filePath = filePath
+      with open(filePath, "rt") as f:
+         self.entries = [tuple(entry) for entry in json.loads(f.read())]
+      self.entries.sort()
+      self.albums = {}
+      for (timeStamp, artistDir, albumDir, trackFile) in self.entries:
+         self.albums.setdefault((artistDir, albumDir), {})[trackFile] = timeStamp
 
    def SaveFile(self, filePath=None):
-      pass
+      if not (filePath or self.filePath):
+         raise NoFilenameError
+
+      if filePath:
+         self.filePath = filePath
+
+      with open(self.filePath, "wt") as f:
+         f.write(json.dumps(self.entries, separators=(',', ':')))
 
 
 class Scanner(object):
@@ -69,17 +199,30 @@ class Scanner(object):
 
       self.libPath = libPath
       self.library = {}
+      self.recent = Recent()
       self.filePath = filePath
       if filePath:
          self.LoadFile(filePath)
 
-      self.recent = Recent()
-
 
    def LoadFile(self, filePath):
+      ''' Load a library file, which may either be JSON or a binary 
+         libraryIndex file.
+      '''
       self.filePath = filePath
-      with open(filePath, "rt") as f:
-         self.library = json.loads(f.read())
+      if libraryIndex.IsIndexFile(filePath):
+         index = libraryIndex.LibraryIndex(filePath)
+         self.library = index.ToLibrary()
+         index.Close()
+      else:
+         with open(filePath, "rt") as f:
+            self.library = json.loads(f.read())
+
+      recentPath = RecentPath(filePath)
+      if os.path.exists(recentPath):
+         self.recent.LoadFile(recentPath)
+      else:
+         self.recent.Rebuild(self.library)
 
    def SaveFile(self, filePath=None):
       if not (filePath or self.filePath):
@@ -89,100 +232,160 @@ class Scanner(object):
          # replace the existing filePath with this new one.
          self.filePath = filePath
 
-      with open(self.filePath, "wt") as f:
-         f.write(json.dumps(self.library, sort_keys=True, 
-            indent=4, separators=(',', ': ')))
+      self.recent.SaveFile(RecentPath(self.filePath))
+
+      # files with the binary index extension get saved in that format, 
+      # everything else as JSON.
+      if self.filePath.endswith(libraryIndex.kIndexExtension):
+         libraryIndex.WriteIndex(self.library, self.filePath)
+      else:
+         with open(self.filePath, "wt") as f:
+            f.write(json.dumps(self.library, sort_keys=True, 
+               indent=4, separators=(',', ': ')))
+
+
+   def TrackCount(self, subdirs=None):
+      ''' Return the number of tracks that we know about, either in the whole 
+         library or only in the list of subdirectories (relative to the top 
+         of the library, either 'Artist' or 'Artist/Album') 
+
+      >>> s = Scanner('/music')
+      >>> s.library = {'A': {'a1': {'__mtime': 0, 't1': {}, 't2': {}}, 
+      ...    'a2': {'t1': {}}}, 'B': {'b1': {'t1': {}}}}
+      >>> s.TrackCount()
+      4
+      >>> s.TrackCount(['A/a1', 'B', 'C/c1'])
+      3
+      '''
+      def CountAlbum(album):
+         return len(Names(album))
+
+      def CountArtist(artist):
+         return sum(CountAlbum(artist[k]) for k in Names(artist))
+
+      if not subdirs:
+         return sum(CountArtist(artist) for artist in self.library.values())
 
+      count = 0
+      for subdir in subdirs:
+         parts = [p for p in subdir.split("/") if p]
+         artist = self.library.get(parts[0], {})
+         if len(parts) > 1:
+            count += CountAlbum(artist.get(parts[1], {}))
+         else:
+            count += CountArtist(artist)
+      return count
 
-   def Scan(self, forceScan=False):
-      source = fileSource.FileSource(self.libPath)
 
-      currentArtist = None
-      artistName = ''
-      currentAlbum = None
-      albumName = ''
-      history = None
-      needsUpdating = False
-      depth = 0
-      now = time.time()
+   def Scan(self, forceScan=False, jobs=4):
+      ''' Bring our library data up to date with what's on disk. 
 
-      for (t, f) in source:
-         #print t, f
+         We only look inside album directories whose modification time has 
+         changed since the last time we scanned them (or all of them if 
+         forceScan is True), and read the tags of the tracks in those albums 
+         using `jobs` threads. Albums and artists that have disappeared from
+         disk are removed from the library.
+
+         Returns a ScanReport listing the tracks that were added, changed, or 
+         removed.
+      '''
+      report = ScanReport()
+      ListEntries = fileSource.kListers[fileSource.kDefaultLister]
+
+      # First pass: find the album directories that need to be looked at. This
+      # only needs to list the artist directories and stat the album directories.
+      dirtyAlbums = []
+      artistDirs, _ = ListEntries(self.libPath)
+      artistNames = set()
+      for artistDir in sorted(artistDirs):
+         _, artistName = os.path.split(artistDir)
+         artistNames.add(artistName)
+         currentArtist = self.library.setdefault(artistName, {})
+         albumDirs, _ = ListEntries(artistDir)
+         albumNames = set()
+         for albumDir in sorted(albumDirs):
+            _, albumName = os.path.split(albumDir)
+            albumNames.add(albumName)
+            currentAlbum = currentArtist.setdefault(albumName, {})
+            lastModified = os.stat(albumDir).st_mtime
+            lastUpdated = currentAlbum.get(kLastModified, 0)
+            if forceScan or (lastModified > lastUpdated):
+               dirtyAlbums.append((artistName, albumName, albumDir, lastModified))
+
+         # prune any albums that are gone.
+         for albumName in Names(currentArtist):
+            if albumName not in albumNames:
+               self.RemoveAlbum(artistName, albumName, report)
+
+      # ...and any artists that are gone.
+      for artistName in Names(self.library):
+         if artistName not in artistNames:
+            for albumName in Names(self.library[artistName]):
+               self.RemoveAlbum(artistName, albumName, report)
+            del self.library[artistName]
+
+      # Second pass: re-read the albums that have changed. 
+      pool = workerPool.WorkerPool(jobs)
+      for (artistName, albumName, albumDir, lastModified) in dirtyAlbums:
+         print os.path.join(artistName, albumName).encode("utf-8")
+         self.ScanAlbum(artistName, albumName, albumDir, pool, report)
+         # don't update the timestamp until we've read all of its tracks.
+         pool.Drain()
+         self.library[artistName][albumName][kLastModified] = lastModified
+      pool.Close()
+      return report
+
+
+   def ScanAlbum(self, artistName, albumName, albumDir, pool, report):
+      ''' Update the tracks in a single album directory, handing the work of 
+         reading each file's tags to the worker pool.
+      '''
+      currentAlbum = self.library[artistName][albumName]
+      history = trackHistory.History(albumDir)
+      _, files = fileSource.kListers[fileSource.kDefaultLister](albumDir)
+      trackNames = set()
+
+      for f in sorted(files):
          _, itemName = os.path.split(f)
-         if fileSource.kDirectory == t:
-            if 0 == depth:
-               # top level of the hierarchy -- at this point we know nothing.
-               assert currentArtist is None
-               assert currentAlbum is None
-            elif 1 == depth:
-               # Just entered an Artist directory. 
-               assert currentArtist is None
-               assert currentAlbum is None
-               currentArtist = self.library.setdefault(itemName, {})
-               artistName = itemName
-            elif 2 == depth:
-               # just entered an album directory
-               assert currentArtist is not None
-               assert currentAlbum is None
-               assert history is None
-               # see if this directory has been modified since the last time
-               # we looked at it.
-               currentAlbum = currentArtist.setdefault(itemName, {})
-               albumName = itemName
-               st = os.stat(f)
-               lastModified = st.st_mtime
-               lastUpdated = currentAlbum.setdefault(kLastModified, 0)
-               needsUpdating = forceScan or (lastModified > lastUpdated)
-               history = trackHistory.History(f)
-            else: 
-               # deeper? Shouldn't happen. We should handle this more elegantly
-               # than throwing an assertion error, though.
-               assert False, "Hierarchy goes too deep!"
-            depth += 1
-            pass
-         elif fileSource.kMusic == t:
-            assert currentAlbum is not None
-            assert history is not None
-            if needsUpdating:
-               print f
-               trackName, _ = os.path.splitext(itemName)
-               trackInfo = currentAlbum.setdefault(trackName, {})
-               if history.fileExists:
-                  acq, move = history.GetTrack(itemName)
-                  trackInfo['acquired'] = acq
-                  trackInfo['moved'] = move
-                  self.recent.AddRecent(artistName, albumName, trackName, acq)
-                  mp3 = fileDestination.Mp3File(f)
-                  for attr in kTrackAttributes:
-                     trackInfo[attr] = getattr(mp3, attr)
-
-         elif fileSource.kOtherFile == t:
-            pass
-         elif fileSource.kExitDirectory == t:
-            depth -= 1
-            if 2 == depth:
-               # leaving an album directory. 
-               assert currentAlbum is not None
-               assert currentArtist is not None
-               assert history is not None 
-               if needsUpdating:
-                  st = os.stat(f)
-                  currentAlbum[kLastModified] = st.st_mtime
-                  needsUpdating = False
-               currentAlbum = None
-               history = None
-            elif 1 == depth:
-               # leaving an artist directory.
-               assert currentAlbum is None
-               assert currentArtist is not None
-               currentArtist = None
-            elif 0 == depth:
-               # leaving the top level directory, which should only happen as 
-               # the very last thing we do here.
-               assert currentAlbum is None
-               assert currentArtist is  None
+         trackName, ext = os.path.splitext(itemName)
+         if ext.lower() != u".mp3":
+            continue
+         trackNames.add(trackName)
+
+         def OnDone(trackInfo, error, f=f, itemName=itemName, trackName=trackName):
+            if error:
+               print "ERROR reading {0}: {1}".format(f.encode("utf-8"), error)
+               return
+            acq, move = history.GetTrack(itemName)
+            trackInfo['acquired'] = acq
+            trackInfo['moved'] = move
+            if acq:
+               self.recent.AddRecent(artistName, albumName, itemName, acq)
             else:
-               assert False, "Hierarchy error!"
+               self.recent.RemoveTracks(artistName, albumName, [trackName])
+            trackPath = os.path.join(artistName, albumName, trackName)
+            oldInfo = currentAlbum.get(trackName)
+            if oldInfo is None:
+               report.added.append(trackPath)
+            elif oldInfo != trackInfo:
+               report.changed.append(trackPath)
+            currentAlbum[trackName] = trackInfo
+
+         pool.Submit(ReadTrack, (f,), OnDone)
+
+      for trackName in Names(currentAlbum):
+         if trackName not in trackNames:
+            report.removed.append(os.path.join(artistName, albumName, trackName))
+            del currentAlbum[trackName]
+            self.recent.RemoveTracks(artistName, albumName, [trackName])
+
+
+   def RemoveAlbum(self, artistName, albumName, report):
+      ''' remove an album that's no longer on disk from the library. '''
+      album = self.library[artistName].pop(albumName)
+      for trackName in Names(album):
+         report.removed.append(os.path.join(artistName, albumName, trackName))
+      self.recent.RemoveTracks(artistName, albumName)
 
 
 
@@ -190,5 +393,34 @@ class Scanner(object):
 
 
 if __name__ == "__main__":
-   import doctest
-   doctest.testmod()
\ No newline at end of file
+   import sys
+   import argparse
+   parser = argparse.ArgumentParser("Scan a music library into a library file.")
+   parser.add_argument("-t", "--test", action='store_true', 
+      help ="run unit tests (other options ignored)")
+   parser.add_argument("-s", "--src", action="store", nargs="?",
+      default=os.getcwd(), help="Top directory of the music library")
+   parser.add_argument("-f", "--file", action="store", nargs="?",
+      default="library.json", 
+      help="Library file to update (use a {0} extension for the binary format)".format(
+         libraryIndex.kIndexExtension))
+   parser.add_argument("-F", "--force", action="store_true", 
+      help="Re-read every album, even if it hasn't changed")
+   parser.add_argument("-j", "--jobs", action="store", nargs="?", type=int,
+      default=4, help="Number of threads to read tags with")
+
+   args = parser.parse_args()
+
+   if args.test:
+      import doctest
+      print "running module tests."
+      doctest.testmod()
+      print "done."
+      sys.exit(0)
+
+   scanner = Scanner(unicode(args.src))
+   if os.path.exists(args.file):
+      scanner.LoadFile(args.file)
+   report = scanner.Scan(args.force, args.jobs)
+   scanner.SaveFile(args.file)
+   print report
\ No newline at end of file
@@ -0,0 +1,312 @@
+#! /usr/bin/env python
+
+'''
+   Benchmarks for the expensive parts of these utilities. Each benchmark
+   builds whatever synthetic files it needs in a temporary directory, so these
+   can be run anywhere that mutagen is installed.
+
+   usage: benchmark.py [-n COUNT] {copy,names,opens,walk}
+'''
+
+import __builtin__
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+from mutagen.easyid3 import EasyID3
+from mutagen.mp3 import MP3
+
+import copyEngine
+import fileDestination
+import fileSource
+
+# a single silent MPEG-1 Layer III frame: 128kbps, 44.1kHz, no padding.
+kFrameHeader = "\xff\xfb\x90\x64"
+kFrameSize = 417
+
+
+def MakeTestFile(path, artist, album, title, trackNum, genre="Jazz",
+      frameCount=40, year="2001"):
+   ''' write a small (but valid) tagged MP3 file to `path`. '''
+   frame = kFrameHeader + "\x00" * (kFrameSize - len(kFrameHeader))
+   with open(path, "wb") as f:
+      f.write(frame * frameCount)
+   tags = EasyID3()
+   tags["artist"] = artist
+   tags["album"] = album
+   tags["title"] = title
+   tags["tracknumber"] = unicode(trackNum)
+   tags["genre"] = genre
+   tags["date"] = year
+   tags.save(path)
+
+
+def MakeTestAlbum(baseDir, trackCount, artist=u"Test Artist", album=u"Test Album"):
+   ''' create a directory of MP3 files, returning a list of their paths. '''
+   albumDir = os.path.join(baseDir, artist, album)
+   os.makedirs(albumDir)
+   paths = []
+   for i in range(trackCount):
+      path = os.path.join(albumDir, u"{0:02}-track.mp3".format(i + 1))
+      MakeTestFile(path, artist, album, u"Track {0}".format(i + 1), i + 1)
+      paths.append(path)
+   return paths
+
+
+class OpenCounter(object):
+   ''' Context manager that counts the calls to the builtin open() (which is
+      what mutagen uses to read files) while it's active.
+   '''
+   def __enter__(self):
+      self.count = 0
+      self.original = __builtin__.open
+      def CountingOpen(*args, **kwargs):
+         self.count += 1
+         return self.original(*args, **kwargs)
+      __builtin__.open = CountingOpen
+      return self
+
+   def __exit__(self, *args):
+      __builtin__.open = self.original
+
+
+class CallCounter(object):
+   ''' Context manager that counts calls to functions in the os module (e.g. 
+      os.stat), replacing them with counting wrappers while it's active.
+   '''
+   def __init__(self, *names):
+      self.names = names
+
+   def __enter__(self):
+      self.counts = dict.fromkeys(self.names, 0)
+      self.originals = {}
+      for name in self.names:
+         self.originals[name] = getattr(os, name)
+         setattr(os, name, self.Wrap(name, self.originals[name]))
+      return self
+
+   def Wrap(self, name, original):
+      def Counting(*args, **kwargs):
+         self.counts[name] += 1
+         return original(*args, **kwargs)
+      return Counting
+
+   def __exit__(self, *args):
+      for name, original in self.originals.items():
+         setattr(os, name, original)
+
+
+class Quiet(object):
+   ''' Context manager that swallows anything printed to stdout. '''
+   def __enter__(self):
+      self.stdout = sys.stdout
+      sys.stdout = open(os.devnull, "w")
+
+   def __exit__(self, *args):
+      sys.stdout.close()
+      sys.stdout = self.stdout
+
+
+def Report(label, count, trackCount, elapsed):
+   print "{0:<40} {1:6.2f} opens/track  {2:8.3f} ms/track".format(label,
+      float(count) / trackCount, 1000.0 * elapsed / trackCount)
+
+
+def BenchOpens(trackCount):
+   ''' Count how many times we open each source file while reading its
+      metadata and handing it off to be transcoded.
+   '''
+   tempDir = tempfile.mkdtemp()
+   try:
+      paths = MakeTestAlbum(os.path.join(tempDir, u"src"), trackCount)
+
+      def ParseSeparately(path):
+         # the way that Mp3File used to read tags and stream info.
+         EasyID3(path)
+         MP3(path)
+
+      with OpenCounter() as counter:
+         start = time.time()
+         for path in paths:
+            ParseSeparately(path)
+         Report("EasyID3() + MP3()", counter.count, trackCount,
+            time.time() - start)
+
+      with OpenCounter() as counter:
+         start = time.time()
+         for path in paths:
+            fileDestination.Mp3File(path)
+         Report("Mp3File()", counter.count, trackCount, time.time() - start)
+
+      # a debug-mode transcode goes through all the metadata handling without
+      # running LAME or touching the destination.
+      dest = fileDestination.FileDestination(os.path.join(tempDir, u"dest"),
+         "copy", "force", "128", debug=True)
+      with OpenCounter() as counter, Quiet():
+         start = time.time()
+         for path in paths:
+            dest.HandleMusic(path)
+         elapsed = time.time() - start
+      Report("FileDestination.HandleMusic() (debug)", counter.count, trackCount,
+         elapsed)
+   finally:
+      shutil.rmtree(tempDir)
+
+
+def MakeTestTree(baseDir, fileCount, tracksPerAlbum=10, albumsPerArtist=5):
+   ''' create a tree of (empty) files laid out like our library, with a cover
+      image in each album directory in addition to the tracks.
+   '''
+   made = 0
+   artistNum = 0
+   while made < fileCount:
+      artistNum += 1
+      for albumNum in range(albumsPerArtist):
+         albumDir = os.path.join(baseDir, u"Artist-{0:05}".format(artistNum),
+            u"2001_Album-{0:02}".format(albumNum))
+         os.makedirs(albumDir)
+         open(os.path.join(albumDir, u"cover.jpg"), "w").close()
+         made += 1
+         for trackNum in range(tracksPerAlbum - 1):
+            open(os.path.join(albumDir, u"{0:02}_Track.mp3".format(trackNum)), 
+               "w").close()
+            made += 1
+
+
+def BenchWalk(fileCount):
+   ''' Compare the directory walkers in fileSource on a synthetic library. '''
+   tempDir = tempfile.mkdtemp()
+   try:
+      print "Building a tree of {0} files...".format(fileCount)
+      MakeTestTree(tempDir, fileCount)
+      events = {}
+      for lister in sorted(fileSource.kListers):
+         with CallCounter("stat", "listdir") as counter:
+            start = time.time()
+            events[lister] = list(fileSource.FileSource(unicode(tempDir), 
+               lister=lister))
+            elapsed = time.time() - start
+         print "{0:<10} {1:8} os.stat() {2:6} os.listdir() {3:8.3f} sec".format(
+            lister, counter.counts["stat"], counter.counts["listdir"], elapsed)
+      if len(set(tuple(e) for e in events.values())) != 1:
+         print "ERROR: walkers returned different results!"
+   finally:
+      shutil.rmtree(tempDir)
+
+
+def BenchCopy(megabytes):
+   ''' Compare the throughput of each of the copy engine's methods (and a 
+      rename) copying one large file into the same directory.
+   '''
+   tempDir = tempfile.mkdtemp()
+   try:
+      src = os.path.join(tempDir, "src")
+      block = os.urandom(1024 * 1024)
+      with open(src, "wb") as f:
+         for i in range(megabytes):
+            f.write(block)
+      for (name, func) in copyEngine.kMethods:
+         engine = copyEngine.CopyEngine([name])
+         start = time.time()
+         used = engine.Copy(src, os.path.join(tempDir, name))
+         elapsed = time.time() - start
+         note = "" if used == name else "  (not supported here; fell back to {0})".format(used)
+         print "{0:<10} {1:10.1f} MB/s{2}".format(name, megabytes / max(elapsed, 0.000001),
+            note)
+      start = time.time()
+      copyEngine.CopyEngine().Move(src, os.path.join(tempDir, "moved"))
+      elapsed = time.time() - start
+      print "{0:<10} {1:10.1f} MB/s".format("rename", megabytes / max(elapsed, 0.000001))
+   finally:
+      shutil.rmtree(tempDir)
+
+
+def OldScrub(s):
+   ''' the way that fileDestination.Scrub() used to work, for comparison. '''
+   try:
+      for c in u":/\\?<>,!":
+         s = s.replace(c, u" ")
+      for c in u"\"'.":
+         s = s.replace(c, u"")
+      s = s.replace('[', '(')
+      s = s.replace(']', ')')
+      s = re.sub("\s+", u" ", s)
+      s = s.strip()
+      s = s.replace(u' ', u'-')
+      s = re.sub("-+", u'-', s)
+      return s.rstrip('.')
+   except UnicodeDecodeError, e:
+      return OldScrub(s.decode("utf-8"))
+
+
+def OldArtistSort(s):
+   s = s.strip()
+   if s.lower().startswith("the ") and s.lower() != "the the":
+      s = s[4:]
+   return s
+
+
+def MakeTagTuples(count, tracksPerAlbum=20, albumsPerArtist=5):
+   ''' (albumArtist, albumName, trackNum, trackArtist, title) tuples laid out
+      like a real library, where the artist & album repeat for each track.
+   '''
+   tuples = []
+   for i in range(count):
+      albumNum, trackNum = divmod(i, tracksPerAlbum)
+      artistNum = albumNum // albumsPerArtist
+      tuples.append((u"The Artist, No. {0}".format(artistNum),
+         u"2001_Album: [Volume {0}] (Live!)".format(albumNum),
+         u"{0:02}".format(trackNum + 1), u"",
+         u"Track {0}?  It's \"{1}\"...".format(trackNum + 1, i)))
+   return tuples
+
+
+def BenchNames(count):
+   ''' Time working out the destination directory & file name for each of
+      `count` tracks, the old way and the new.
+   '''
+   tuples = MakeTagTuples(count)
+
+   def OldName(artist, album, trackNum, trackArtist, title):
+      path = os.path.join(OldScrub(OldArtistSort(artist)), OldScrub(album))
+      return path, u"_".join(OldScrub(w) for w in (trackNum, 
+         OldArtistSort(trackArtist), title) if w)
+
+   def NewName(artist, album, trackNum, trackArtist, title):
+      path = fileDestination.AlbumPath(fileDestination.ArtistSort(artist), album)
+      return path, u"_".join(fileDestination.Scrub(w) for w in (trackNum, 
+         fileDestination.ArtistSort(trackArtist), title) if w)
+
+   names = {}
+   for (label, func) in (("old Scrub()", OldName), ("memoized Scrub()", NewName)):
+      start = time.time()
+      names[label] = [func(*t) for t in tuples]
+      elapsed = time.time() - start
+      print "{0:<20} {1:8.2f} usec/track".format(label, 1000000.0 * elapsed / count)
+   if len(set(tuple(n) for n in names.values())) != 1:
+      print "ERROR: the names are different!"
+
+
+# name : (function, default count)
+kBenchmarks = {
+   "copy": (BenchCopy, 256),
+   "names": (BenchNames, 100000),
+   "opens": (BenchOpens, 200),
+   "walk": (BenchWalk, 50000),
+}
+
+
+if __name__ == "__main__":
+   import argparse
+   parser = argparse.ArgumentParser("Benchmark mp3utilities operations.")
+   parser.add_argument("-n", "--count", action="store", nargs="?", type=int,
+      default=None, help="Number of synthetic files to use (MB to copy for `copy')")
+   parser.add_argument("benchmark", choices=sorted(kBenchmarks.keys()),
+      help="Which benchmark to run")
+
+   args = parser.parse_args()
+   func, count = kBenchmarks[args.benchmark]
+   func(args.count or count)
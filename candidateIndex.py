@@ -0,0 +1,133 @@
+'''
+   An in-memory index of the tracks that shuffler.py can choose from.
+
+   We read the tags of every source track once (quickly, if there's a
+   metadata cache) and keep what the shuffler needs to know about each one:
+   its genre, its length, and where it would go on the destination. After
+   that, filtering and picking tracks never has to touch the files again.
+'''
+
+import collections
+import os
+
+import fileDestination
+import transferPlan
+
+# tracks longer than this (in seconds) aren't worth the space.
+kMaxLength = 9 * 60
+
+
+class Candidate(object):
+   ''' what we know about one source track. '''
+   __slots__ = ("path", "fields", "genre", "length", "destPath", "size")
+
+   def __init__(self, path, mp3, destPath):
+      self.path = path
+      # just the values we derived from the tags -- not the Mp3File itself, 
+      # which holds on to all of the file's ID3 frames (cover art and all.)
+      self.fields = mp3.Fields()
+      self.genre = mp3.genre
+      self.length = mp3.length
+      self.destPath = destPath
+      # predicted size on the destination; see CandidateIndex.PredictedSize()
+      self.size = None
+
+   def Mp3(self):
+      ''' an Mp3File for this track that we can hand to 
+         FileDestination.HandleMusic() without it parsing the file again.
+      '''
+      return fileDestination.Mp3File.FromFields(self.path, self.fields)
+
+
+class CandidateIndex(object):
+   def __init__(self, dest):
+      '''
+         dest -- the FileDestination that tracks will be copied to, which
+            decides where each of them would go.
+
+      >>> class Track(object):
+      ...    def __init__(self, genre, length):
+      ...       self.genre, self.length = genre, length
+      ...    def Fields(self):
+      ...       return {"genre": self.genre, "length": self.length}
+      >>> class Dest(object):
+      ...    def MusicDestination(self, mp3):
+      ...       return u'/dest/{0}-{1}.mp3'.format(mp3.genre, mp3.length)
+      >>> index = CandidateIndex(Dest())
+      >>> index.Add(u'/src/1.mp3', Track(u'Jazz', 200))
+      >>> index.Add(u'/src/2.mp3', Track(u'Polka', 200))
+      >>> index.Add(u'/src/3.mp3', Track(u'Jazz', 1200))
+      >>> index.Add(u'/src/4.mp3', Track(u'Rock', 100))
+      >>> [index[i].path for i in index.Filter((u'Jazz', u'Rock'))]
+      [u'/src/1.mp3', u'/src/4.mp3']
+      >>> index.Filter((u'Jazz', u'Rock'), exclude=set([u'/dest/Rock-100.mp3']))
+      [0]
+      >>> index.Find(u'/src/2.mp3').destPath
+      u'/dest/Polka-200.mp3'
+      '''
+      self.dest = dest
+      self.candidates = []
+      # {genre : [index of each candidate with that genre]}
+      self.byGenre = collections.defaultdict(list)
+      # {source path : index}
+      self.byPath = {}
+
+   def __len__(self):
+      return len(self.candidates)
+
+   def __getitem__(self, i):
+      return self.candidates[i]
+
+   def Add(self, path, mp3):
+      destPath = os.path.abspath(self.dest.MusicDestination(mp3))
+      i = len(self.candidates)
+      self.candidates.append(Candidate(path, mp3, destPath))
+      self.byGenre[mp3.genre].append(i)
+      self.byPath[path] = i
+
+   def Build(self, paths):
+      ''' add each of the music files in `paths`, skipping (and reporting) any
+         that we can't read the tags from.
+      '''
+      for path in paths:
+         try:
+            self.Add(path, fileDestination.Mp3File(path))
+         except (fileDestination.MetadataException,
+               fileDestination.InvalidFileException) as e:
+            print "ERROR: skipping {0}: {1}".format(path.encode("utf-8"), e)
+      return self
+
+   def Find(self, path):
+      ''' the Candidate for a source path, or None. '''
+      i = self.byPath.get(path)
+      return None if i is None else self.candidates[i]
+
+   def PredictedSize(self, candidate):
+      ''' how many bytes the candidate will take up once it's on the 
+         destination -- which depends on whether it'll be transcoded. 
+      '''
+      if candidate.size is None:
+         if "transcode" == self.dest.MusicAction(candidate.Mp3(), candidate.destPath):
+            candidate.size = transferPlan.EstimateSize(candidate.length, 
+               self.dest.rate, self.dest.vbr)
+         else:
+            candidate.size = os.path.getsize(candidate.path)
+      return candidate.size
+
+   def Filter(self, genres, maxLength=kMaxLength, exclude=frozenset()):
+      ''' Return a sorted list of the indexes of the candidates in one of
+         `genres` that are shorter than maxLength seconds and whose
+         destination paths aren't in the set `exclude`.
+      '''
+      retval = []
+      for genre in genres:
+         retval.extend(i for i in self.byGenre.get(genre, ())
+            if self.candidates[i].length < maxLength and
+            self.candidates[i].destPath not in exclude)
+      retval.sort()
+      return retval
+
+
+if __name__ == "__main__":
+   import doctest
+   doctest.testmod()
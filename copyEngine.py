@@ -0,0 +1,193 @@
+'''
+   Fast file copies for FileDestination.
+
+   To copy a file we try, in order:
+   - a reflink (the FICLONE ioctl), which on filesystems that support it
+     (btrfs, XFS...) makes a copy-on-write clone without copying any data.
+   - sendfile(), which copies the data inside the kernel. Python 2 doesn't
+     have os.sendfile, so on Linux we call the C library's directly.
+   - a plain read/write loop with a large buffer.
+   Each of these reports whether it worked, so the first one that isn't
+   supported for a pair of files just hands off to the next.
+
+   Moves are a rename if the source and destination are on the same device,
+   and a copy followed by deleting the source otherwise.
+'''
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import shutil
+import sys
+import threading
+
+try:
+   import fcntl
+except ImportError:
+   fcntl = None
+
+# from <linux/fs.h>: _IOW(0x94, 9, int)
+kFiClone = 0x40049409
+
+kBufferSize = 1024 * 1024
+
+
+def _LibcSendfile():
+   ''' return a function with the same signature as Python 3's os.sendfile()
+      that calls sendfile(2) through ctypes, or None if we can't.
+   '''
+   if not sys.platform.startswith("linux"):
+      return None
+   try:
+      libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+      func = libc.sendfile
+   except (OSError, AttributeError):
+      return None
+   func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+      ctypes.c_size_t]
+   func.restype = ctypes.c_ssize_t
+
+   def Sendfile(outFd, inFd, offset, count):
+      pos = ctypes.c_int64(offset)
+      sent = func(outFd, inFd, ctypes.byref(pos), count)
+      if sent < 0:
+         err = ctypes.get_errno()
+         raise OSError(err, os.strerror(err))
+      return sent
+   return Sendfile
+
+_sendfile = getattr(os, "sendfile", None) or _LibcSendfile()
+
+
+def Reflink(src, dest, size):
+   ''' Clone src into dest (both open file objects). Returns False if the
+      filesystem (or OS) can't do that.
+   '''
+   if fcntl is None:
+      return False
+   try:
+      fcntl.ioctl(dest.fileno(), kFiClone, src.fileno())
+   except (IOError, OSError):
+      return False
+   return True
+
+
+def Sendfile(src, dest, size):
+   ''' copy src into dest inside the kernel. Returns False if sendfile()
+      isn't available or won't work with these files.
+   '''
+   if _sendfile is None:
+      return False
+   offset = 0
+   while offset < size:
+      try:
+         sent = _sendfile(dest.fileno(), src.fileno(), offset, size - offset)
+      except OSError, e:
+         if 0 == offset and e.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+            return False
+         raise IOError(e.errno, e.strerror)
+      if 0 == sent:
+         # the file got shorter while we were copying it.
+         break
+      offset += sent
+   return True
+
+
+def BufferedCopy(src, dest, size):
+   ''' the last resort, which always works. '''
+   shutil.copyfileobj(src, dest, kBufferSize)
+   return True
+
+
+# (name, function) for each copy method, in the order we try them.
+kMethods = [
+   ("reflink", Reflink),
+   ("sendfile", Sendfile),
+   ("buffered", BufferedCopy),
+]
+
+
+class CopyEngine(object):
+   def __init__(self, methods=None):
+      '''
+         methods -- names of the copy methods to try (default: all of them.)
+         We always fall back to a buffered copy if the others don't work.
+
+      >>> import tempfile
+      >>> tempDir = tempfile.mkdtemp()
+      >>> src = os.path.join(tempDir, "src")
+      >>> with open(src, "wb") as f:
+      ...    f.write("x" * 100000)
+      >>> engine = CopyEngine()
+      >>> engine.Copy(src, os.path.join(tempDir, "copy")) in dict(kMethods)
+      True
+      >>> open(os.path.join(tempDir, "copy"), "rb").read() == "x" * 100000
+      True
+      >>> CopyEngine(["buffered"]).Copy(src, os.path.join(tempDir, "b"))
+      'buffered'
+      >>> engine.Move(src, os.path.join(tempDir, "moved"))
+      'rename'
+      >>> os.path.exists(src)
+      False
+      >>> sum(engine.counts.values())
+      2
+      >>> shutil.rmtree(tempDir)
+      '''
+      methods = methods or [name for (name, func) in kMethods]
+      self.methods = [(name, func) for (name, func) in kMethods if name in methods]
+      if "buffered" not in methods:
+         self.methods.append(kMethods[-1])
+      # number of files and bytes we've handled with each method, which
+      # may be called from several threads.
+      self.lock = threading.Lock()
+      self.counts = collections.Counter()
+      self.bytes = collections.Counter()
+
+   def _Record(self, method, size):
+      with self.lock:
+         self.counts[method] += 1
+         self.bytes[method] += size
+
+   def Copy(self, srcFile, destFile):
+      ''' Copy the contents of srcFile to destFile, returning the name of the
+         method that did it. Raises IOError/OSError if the copy fails.
+      '''
+      with open(srcFile, "rb") as src:
+         size = os.fstat(src.fileno()).st_size
+         with open(destFile, "wb") as dest:
+            for (name, func) in self.methods:
+               if func(src, dest, size):
+                  break
+      self._Record(name, size)
+      return name
+
+   def Move(self, srcFile, destFile):
+      ''' Move srcFile to destFile, renaming it if we can. Returns the name of
+         the method used.
+      '''
+      try:
+         os.rename(srcFile, destFile)
+      except OSError, e:
+         if e.errno != errno.EXDEV:
+            raise
+      else:
+         self._Record("rename", os.path.getsize(destFile))
+         return "rename"
+      # a different device, so we have to copy it across.
+      method = self.Copy(srcFile, destFile)
+      shutil.copystat(srcFile, destFile)
+      os.remove(srcFile)
+      return method
+
+   def Summary(self):
+      ''' e.g. "3 reflink, 12 buffered (45.1 MB)" '''
+      return ", ".join("{0} {1} ({2:.1f} MB)".format(count, method,
+         self.bytes[method] / (1024.0 * 1024))
+         for (method, count) in sorted(self.counts.items()))
+
+
+if __name__ == "__main__":
+   import doctest
+   doctest.testmod()
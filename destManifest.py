@@ -0,0 +1,178 @@
+'''
+   A manifest of the tracks on a shuffler.py destination drive, so we don't
+   have to walk the whole (slow, FAT formatted) drive at the start of every
+   run to find out what's there.
+
+   The manifest lives at the top of the drive. It lists each track's path
+   (relative to the top of the drive), its size, and the source file it was
+   copied from, if we know that. Its first line is a fixed-width header that
+   records the state of the volume (total/free blocks and inodes) as of the
+   last time we saved the manifest. If anything has changed on the drive
+   since then that we didn't know about, the volume state won't match, and
+   we fall back to walking the drive.
+
+   To keep the header honest, we write the rest of the manifest first (via
+   a temp file and a rename, so there's never a half-written manifest), then
+   check the volume state, then overwrite the header in place -- which
+   doesn't change how much space the file takes up.
+'''
+
+import json
+import os
+
+import fileSource
+import trackHistory
+
+kManifestFileName = u".shuffler-manifest"
+kVersion = 1
+kHeaderSize = 255
+
+# save after this many changes, so an interrupted run usually leaves us
+# with a manifest that we can still use.
+kSaveInterval = 50
+
+
+def ManifestPath(destDir):
+   '''
+   >>> ManifestPath(u'/media/usb1')
+   u'/media/usb1/.shuffler-manifest'
+   '''
+   return os.path.join(destDir, kManifestFileName)
+
+
+def VolumeState(path):
+   ''' numbers that change whenever anything on the volume that holds `path`
+      is created, deleted, or changes size.
+   '''
+   st = os.statvfs(path)
+   return [st.f_blocks, st.f_bfree, st.f_files, st.f_ffree]
+
+
+def FreeBytes(path):
+   ''' how many bytes we can still write to the volume holding `path`. '''
+   st = os.statvfs(path)
+   return st.f_bavail * st.f_frsize
+
+
+class Manifest(object):
+   def __init__(self, destDir):
+      '''
+      >>> import shutil, tempfile
+      >>> destDir = tempfile.mkdtemp()
+      >>> os.mkdir(os.path.join(destDir, u'Artist'))
+      >>> track = os.path.join(destDir, u'Artist', u'01_Song.mp3')
+      >>> with open(track, "wb") as f:
+      ...    f.write("x" * 1000)
+      >>> m = Manifest(destDir)
+      >>> m.Load()
+      False
+      >>> m.Rebuild()
+      >>> m.Save()
+      >>> m = Manifest(destDir)
+      >>> m.Load(), m.Size(track)
+      (True, 1000)
+      >>> os.remove(track)
+      >>> m.Remove(track)
+      >>> m.Save()
+      >>> Manifest(destDir).Load(), len(m)
+      (True, 0)
+      >>> shutil.rmtree(destDir)
+      '''
+      self.destDir = os.path.abspath(destDir)
+      self.path = ManifestPath(self.destDir)
+      # {full path : (size, source path or None)}
+      self.tracks = {}
+      self.changes = 0
+
+   def __len__(self):
+      return len(self.tracks)
+
+   def __contains__(self, path):
+      return os.path.abspath(path) in self.tracks
+
+   def Paths(self):
+      return sorted(self.tracks)
+
+   def Size(self, path):
+      return self.tracks[os.path.abspath(path)][0]
+
+   def Source(self, path):
+      return self.tracks[os.path.abspath(path)][1]
+
+   def Load(self):
+      ''' Read the manifest. Returns True if it exists and the volume hasn't
+         changed since it was saved, in which case we can trust it.
+      '''
+      try:
+         with open(self.path, "rt") as f:
+            header = json.loads(f.readline())
+            if header.get("version") != kVersion:
+               return False
+            if header.get("volume") != VolumeState(self.destDir):
+               return False
+            tracks = {}
+            for line in f:
+               entry = json.loads(line)
+               tracks[os.path.join(self.destDir, entry["path"])] = (entry["size"],
+                  entry.get("src"))
+      except (IOError, OSError, ValueError):
+         return False
+      self.tracks = tracks
+      return True
+
+   def Rebuild(self):
+      ''' Walk the destination to find out what's there. We don't know where
+         these tracks came from.
+      '''
+      self.tracks = {}
+      for (fileType, path) in fileSource.FileSource(self.destDir):
+         if fileSource.kMusic == fileType:
+            self.tracks[os.path.abspath(path)] = (os.path.getsize(path), None)
+      self.changes += 1
+
+   def _Changed(self):
+      self.changes += 1
+      if self.changes >= kSaveInterval:
+         self.Save()
+
+   def Add(self, path, size, src=None):
+      self.tracks[os.path.abspath(path)] = (size, src)
+      self._Changed()
+
+   def Remove(self, path):
+      if self.tracks.pop(os.path.abspath(path), None) is not None:
+         self._Changed()
+
+   def _Header(self, volume):
+      header = json.dumps({"version": kVersion, "volume": volume})
+      return header.ljust(kHeaderSize) + "\n"
+
+   def Save(self):
+      ''' write the manifest, then stamp it with the state of the volume. '''
+      lines = [self._Header(None)]
+      for path in self.Paths():
+         size, src = self.tracks[path]
+         lines.append(json.dumps({"path": os.path.relpath(path, self.destDir),
+            "size": size, "src": src}) + "\n")
+      trackHistory.AtomicWrite(self.path, "".join(lines))
+      with open(self.path, "r+b") as f:
+         f.write(self._Header(VolumeState(self.destDir)))
+      self.changes = 0
+
+
+def Open(destDir):
+   ''' return a Manifest for the destination, walking the drive to rebuild
+      it if the one that's there is missing or out of date.
+   '''
+   manifest = Manifest(destDir)
+   if not manifest.Load():
+      print "Manifest at {0} is missing or out of date; checking the whole drive.".format(
+         destDir.encode("utf-8"))
+      manifest.Rebuild()
+      manifest.Save()
+   return manifest
+
+
+if __name__ == "__main__":
+   import doctest
+   doctest.testmod()
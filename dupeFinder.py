@@ -0,0 +1,178 @@
+#! /usr/bin/env python
+
+'''
+   Find duplicate tracks anywhere in the library.
+
+   Two files are duplicates if their audio data is identical, even if their
+   tags are different (e.g. one of them has been re-tagged, so it was filed
+   under a different artist or album name.) We hash each file with its ID3v2
+   header, ID3v1 trailer, and APEv2 tag stripped off, using a pool of
+   processes to do the hashing. The hashes are saved in the metadata cache
+   at the top of the library, so later runs only need to hash files that are
+   new or have changed.
+'''
+
+import collections
+import hashlib
+import multiprocessing
+import os
+import struct
+
+import fileSource
+import metadataCache
+
+kBlockSize = 1024 * 1024
+
+kId3v1Size = 128
+kApeFooterSize = 32
+
+
+def SyncsafeInt(data):
+   ''' decode the 28-bit "syncsafe" integers used in ID3v2 headers.
+   >>> SyncsafeInt("\\x00\\x00\\x02\\x01")
+   257
+   '''
+   b = struct.unpack(">4B", data)
+   return (b[0] << 21) | (b[1] << 14) | (b[2] << 7) | b[3]
+
+
+def AudioRange(f, fileSize):
+   ''' Return (start, end) byte offsets of the audio data in an open MP3 file,
+      skipping over any tags at the beginning or end of the file.
+   '''
+   start = 0
+   f.seek(0)
+   header = f.read(10)
+   if len(header) == 10 and header[:3] == "ID3":
+      start = 10 + SyncsafeInt(header[6:10])
+      # flag bit 4 means there's also a 10 byte footer.
+      if ord(header[5]) & 0x10:
+         start += 10
+
+   end = fileSize
+   if end - start >= kId3v1Size:
+      f.seek(end - kId3v1Size)
+      if f.read(3) == "TAG":
+         end -= kId3v1Size
+   if end - start >= kApeFooterSize:
+      f.seek(end - kApeFooterSize)
+      footer = f.read(kApeFooterSize)
+      if footer[:8] == "APETAGEX":
+         # the tag size includes the footer but not the (optional) header.
+         tagSize, itemCount, flags = struct.unpack("<III", footer[12:24])
+         if flags & 0x80000000:
+            tagSize += kApeFooterSize
+         end -= tagSize
+
+   return start, max(start, end)
+
+
+def HashAudio(path):
+   ''' return the MD5 hex digest of the audio data in the file at `path`. '''
+   md5 = hashlib.md5()
+   with open(path, "rb") as f:
+      start, end = AudioRange(f, os.fstat(f.fileno()).st_size)
+      f.seek(start)
+      remaining = end - start
+      while remaining > 0:
+         block = f.read(min(kBlockSize, remaining))
+         if not block:
+            break
+         md5.update(block)
+         remaining -= len(block)
+   return md5.hexdigest()
+
+
+def HashFile(item):
+   ''' Worker function for the process pool; item is (path, size, mtime).
+      Returns (path, size, mtime, digest), where digest is None if the file
+      couldn't be read.
+   '''
+   path, size, mtime = item
+   try:
+      digest = HashAudio(path)
+   except IOError:
+      digest = None
+   return (path, size, mtime, digest)
+
+
+def AlbumDir(path):
+   ''' the Artist/Year_Album part of a track's path.
+   >>> AlbumDir(u'/music/Kneebody/2008_Low/01_A.mp3')
+   u'Kneebody/2008_Low'
+   '''
+   albumPath = os.path.dirname(path)
+   artistPath, album = os.path.split(albumPath)
+   return os.path.join(os.path.basename(artistPath), album)
+
+
+def FindDuplicates(libPath, cache, jobs=None):
+   ''' Returns a list of duplicate groups, each of which is a sorted list of
+      the paths to files with identical audio that live in more than one
+      album directory.
+   '''
+   digests = collections.defaultdict(list)
+   toHash = []
+   for (fileType, path) in fileSource.FileSource(libPath):
+      if fileSource.kMusic != fileType:
+         continue
+      st = os.stat(path)
+      digest = cache.GetHash(path, st.st_size, st.st_mtime)
+      if digest:
+         digests[digest].append(path)
+      else:
+         toHash.append((path, st.st_size, st.st_mtime))
+
+   if toHash:
+      print "Hashing {0} new or changed files...".format(len(toHash))
+      pool = multiprocessing.Pool(jobs)
+      for (path, size, mtime, digest) in pool.imap_unordered(HashFile, toHash, 16):
+         if digest:
+            cache.PutHash(path, size, mtime, digest)
+            digests[digest].append(path)
+      pool.close()
+      pool.join()
+
+   groups = []
+   for paths in digests.values():
+      if len(set(AlbumDir(p) for p in paths)) > 1:
+         groups.append(sorted(paths))
+   groups.sort()
+   return groups
+
+
+if __name__ == "__main__":
+   import argparse
+   import sys
+   parser = argparse.ArgumentParser("Find duplicate tracks in a music library.")
+   parser.add_argument("-t", "--test", action='store_true',
+      help ="run unit tests (other options ignored)")
+   parser.add_argument("-s", "--src", action="store", nargs="?",
+      default=os.getcwd(), help="root directory of music collection.")
+   parser.add_argument("-k", "--cache", action="store", nargs="?",
+      default="", help="Metadata cache file to keep hashes in (default: {0} in `src')".format(
+         metadataCache.kCacheFileName))
+   parser.add_argument("-j", "--jobs", action="store", nargs="?", type=int,
+      default=None, help="Number of processes to hash files with (default: one per CPU)")
+
+   args = parser.parse_args()
+   if args.test:
+      import doctest
+      print "running module tests."
+      doctest.testmod()
+      print "done."
+      sys.exit(0)
+
+   src = unicode(args.src)
+   cache = metadataCache.MetadataCache(args.cache or metadataCache.CachePath(src))
+   groups = FindDuplicates(src, cache, args.jobs)
+   cache.Close()
+
+   wasted = 0
+   for paths in groups:
+      print
+      for path in paths:
+         print "   {0}".format(path.encode("utf-8"))
+      wasted += sum(os.path.getsize(p) for p in paths[1:])
+   print "\n{0} duplicate groups, {1:.1f} MB in extra copies.".format(len(groups),
+      wasted / (1024.0 * 1024))
@@ -0,0 +1,305 @@
+#! /usr/bin/env python
+
+'''
+   Encoder backends that FileDestination can use to transcode music files.
+
+   Each backend says whether it's installed on this machine and which rates
+   it can produce. The Registry picks the fastest one that can produce the
+   rate we were asked for: the first time we see a backend (or a new version
+   of its program), we time it transcoding a sample file and keep the result
+   in a cache file in the user's home directory so later runs don't need to
+   measure it again.
+
+   If nothing on this machine can transcode to the requested rate, Choose()
+   returns None and the caller can fall back to copying files as they are.
+'''
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from distutils.spawn import find_executable
+
+import trackHistory
+
+kCachePath = os.path.expanduser(u"~/.mp3encoders.json")
+
+# the CBR rates (in kbps) that an MPEG-1/2 Layer III encoder can produce.
+kCbrRates = (8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224,
+   256, 320)
+# ...and the LAME VBR quality levels.
+kVbrLevels = range(10)
+
+
+class Encoder(object):
+   ''' Base class for encoder backends. '''
+   name = None
+   # the executable that has to be on the PATH for us to work.
+   program = None
+
+   def __init__(self):
+      self._path = None
+
+   def Path(self):
+      ''' full path to our executable, or None if it isn't installed. '''
+      if self._path is None and self.program:
+         self._path = find_executable(self.program)
+      return self._path
+
+   def Available(self):
+      return self.Path() is not None
+
+   def CanProduce(self, rate, vbr):
+      ''' True if we can encode at `rate` (kbps, or a VBR quality level if
+         `vbr` is True.)
+      '''
+      if vbr:
+         return rate in kVbrLevels
+      return rate in kCbrRates
+
+   def StreamCommand(self, rate, vbr):
+      ''' the command line to transcode from stdin to stdout, or None if this
+         backend can't do that.
+      '''
+      return None
+
+   def Encode(self, rate, vbr, srcFile, destFile, mp3=None):
+      ''' transcode srcFile into destFile, returning True on success. Backends
+         that run a program give us its command line with 
+         Command(rate, vbr, srcFile, destFile, mp3), where mp3 is the Mp3File 
+         for srcFile if the backend needs its tags.
+      '''
+      cmd = self.Command(rate, vbr, srcFile, destFile, mp3)
+      with open(os.devnull, "wb") as devNull:
+         return subprocess.call(cmd, stdout=devNull, stderr=devNull) == 0
+
+
+class CopyEncoder(Encoder):
+   ''' Doesn't transcode at all, so it can only 'produce' the source rate
+      (which we ask for as a rate of zero.) There's no program to run, so 
+      FileDestination copies the file itself instead of asking us for a 
+      command line.
+   >>> c = CopyEncoder()
+   >>> c.Available(), c.CanProduce(0, False), c.CanProduce(128, False)
+   (True, True, False)
+   '''
+   name = "copy"
+
+   def Available(self):
+      return True
+
+   def CanProduce(self, rate, vbr):
+      return 0 == rate and not vbr
+
+   def Encode(self, rate, vbr, srcFile, destFile, mp3=None):
+      try:
+         shutil.copyfile(srcFile, destFile)
+      except IOError:
+         return False
+      return True
+
+
+class LameEncoder(Encoder):
+   '''
+   >>> LameEncoder().StreamCommand(2, True)
+   ['lame', '-h', '-V', '2', '--quiet', '--mp3input', '-', '-']
+   >>> LameEncoder().Command(128, False, u'in.mp3', u'out.mp3')
+   ['lame', '-h', '-b', '128', '--id3v2-only', '--mp3input', u'in.mp3', u'out.mp3']
+   '''
+   name = "lame"
+   program = "lame"
+
+   # a list of tuples where
+   # [0] is the command line flag to pass to LAME
+   # [1] is the attribute name inside of the Mp3File object.
+   kFields = [ ("--tt", "title"),
+               ("--ta", "artist"),
+               ("--tl", "album"),
+               ("--ty", "year"),
+               ("--tn", "trackNum"),
+               ("--tg", "genre")
+              ]
+
+   def _RateArgs(self, rate, vbr):
+      return ["lame", "-h", "-V" if vbr else "-b", "{0}".format(rate)]
+
+   def Command(self, rate, vbr, srcFile, destFile, mp3=None):
+      cmd = self._RateArgs(rate, vbr)
+      ## make sure that the metadata gets put in the new file correctly.
+      cmd.append("--id3v2-only")
+      for (flag, field) in self.kFields:
+         try:
+            val = getattr(mp3, field)
+            # apparently there's some chance of bogus leading/trailing
+            # double quotes?
+            val = val.strip('"')
+            if val:
+               cmd.extend([flag, u'{0}'.format(val)])
+         except AttributeError:
+            # that metadata field is missing from this file; skip it.
+            pass
+      cmd.extend(['--mp3input', srcFile, destFile])
+      return cmd
+
+   def StreamCommand(self, rate, vbr):
+      return self._RateArgs(rate, vbr) + ['--quiet', '--mp3input', '-', '-']
+
+
+class FfmpegEncoder(Encoder):
+   ''' ffmpeg using its libmp3lame encoder. It copies the tags from the
+      source file itself.
+   >>> FfmpegEncoder().Command(2, True, u'in.mp3', u'out.mp3')[-4:]
+   ['-q:a', '2', '-y', u'out.mp3']
+   '''
+   name = "ffmpeg"
+   program = "ffmpeg"
+
+   def __init__(self):
+      super(FfmpegEncoder, self).__init__()
+      self._hasLame = None
+
+   def Available(self):
+      ''' ffmpeg needs to have been built with libmp3lame. '''
+      if self._hasLame is None:
+         self._hasLame = False
+         if self.Path():
+            try:
+               encoderList = subprocess.check_output([self.Path(), "-hide_banner",
+                  "-encoders"], stderr=subprocess.STDOUT)
+               self._hasLame = "libmp3lame" in encoderList
+            except (OSError, subprocess.CalledProcessError):
+               pass
+      return self._hasLame
+
+   def _RateArgs(self, rate, vbr):
+      args = ["-codec:a", "libmp3lame"]
+      if vbr:
+         args.extend(["-q:a", "{0}".format(rate)])
+      else:
+         args.extend(["-b:a", "{0}k".format(rate)])
+      return args
+
+   def Command(self, rate, vbr, srcFile, destFile, mp3=None):
+      return (["ffmpeg", "-v", "error", "-i", srcFile, "-map_metadata", "0",
+         "-id3v2_version", "3"] + self._RateArgs(rate, vbr) + ["-y", destFile])
+
+   def StreamCommand(self, rate, vbr):
+      return (["ffmpeg", "-v", "error", "-f", "mp3", "-i", "pipe:0"] +
+         self._RateArgs(rate, vbr) + ["-f", "mp3", "pipe:1"])
+
+
+class Registry(object):
+   def __init__(self, encoders=None, cachePath=None):
+      '''
+         encoders -- list of Encoder objects, in order of preference (which
+            only matters if we can't measure them.)
+         cachePath -- file to keep measured throughputs in.
+
+      >>> r = Registry([CopyEncoder()], tempfile.mktemp())
+      >>> r.Choose(0, False).name
+      'copy'
+      >>> r.Choose(128, False) is None
+      True
+      '''
+      if encoders is None:
+         encoders = [LameEncoder(), FfmpegEncoder(), CopyEncoder()]
+      self.encoders = encoders
+      self.cachePath = cachePath or kCachePath
+      try:
+         with open(self.cachePath, "rt") as f:
+            self.cache = json.loads(f.read())
+      except (IOError, ValueError):
+         self.cache = {}
+
+   def Capable(self, rate, vbr):
+      ''' list of the installed encoders that can produce this rate. '''
+      return [e for e in self.encoders if e.CanProduce(rate, vbr) and e.Available()]
+
+   def _CacheKey(self, encoder, rate, vbr):
+      ''' measurements are for one version of one program at one rate. '''
+      path = encoder.Path() or ""
+      mtime = os.stat(path).st_mtime if path else 0
+      return u"{0} {1} {2} {3}{4}".format(encoder.name, path, mtime,
+         "V" if vbr else "", rate)
+
+   def Measure(self, encoder, rate, vbr, sampleFile):
+      ''' time the encoder transcoding sampleFile, returning its throughput in
+         bytes of input per second (zero if it failed.)
+      '''
+      tempDir = tempfile.mkdtemp()
+      try:
+         start = time.time()
+         ok = encoder.Encode(rate, vbr, sampleFile, os.path.join(tempDir,
+            u"sample.mp3"))
+         elapsed = time.time() - start
+      finally:
+         shutil.rmtree(tempDir)
+      if not ok:
+         return 0.0
+      return os.path.getsize(sampleFile) / max(elapsed, 0.001)
+
+   def Throughput(self, encoder, rate, vbr, sampleFile):
+      ''' the throughput of the encoder, from the cache if we've measured it
+         before.
+      '''
+      key = self._CacheKey(encoder, rate, vbr)
+      if key not in self.cache:
+         self.cache[key] = self.Measure(encoder, rate, vbr, sampleFile)
+         try:
+            trackHistory.AtomicWrite(self.cachePath, json.dumps(self.cache,
+               indent=3, sort_keys=True))
+         except (IOError, OSError):
+            # we'll just have to measure again next time.
+            pass
+      return self.cache[key]
+
+   def Choose(self, rate, vbr, sampleFile=None):
+      ''' Return the fastest installed encoder that can produce this rate,
+         or None if there isn't one. Without a sampleFile to measure with, we
+         use the first capable one in our list.
+      '''
+      capable = self.Capable(rate, vbr)
+      if not capable:
+         return None
+      if len(capable) == 1 or sampleFile is None:
+         return capable[0]
+      # max() returns the first of any ties, so our preference order still
+      # counts for something.
+      return max(capable, key=lambda e: self.Throughput(e, rate, vbr, sampleFile))
+
+
+if __name__ == "__main__":
+   import argparse
+   import sys
+   parser = argparse.ArgumentParser("List the encoder backends available on this machine.")
+   parser.add_argument("-t", "--test", action='store_true',
+      help ="run unit tests (other options ignored)")
+   parser.add_argument("-r", "--rate", action="store", nargs="?",
+      default="128", help="Bitrate to check for. Use V[0..9] for VBR")
+   parser.add_argument("sample", nargs="?", help="mp3 file to measure the encoders with")
+
+   args = parser.parse_args()
+   if args.test:
+      import doctest
+      print "running module tests."
+      doctest.testmod()
+      print "done."
+      sys.exit(0)
+
+   vbr = args.rate.lower().startswith("v")
+   rate = int(args.rate[1:] if vbr else args.rate)
+   registry = Registry()
+   for encoder in registry.encoders:
+      status = "not installed"
+      if encoder.Available():
+         status = "can't produce {0}".format(args.rate)
+         if encoder.CanProduce(rate, vbr):
+            status = "ok"
+            if args.sample:
+               status = "{0:.1f} MB/s".format(registry.Throughput(encoder, rate,
+                  vbr, args.sample) / (1024.0 * 1024))
+      print "{0:8} {1}".format(encoder.name, status)
+   best = registry.Choose(rate, vbr, args.sample)
+   print "Would use: {0}".format(best.name if best else "nothing (files would be copied)")
@@ -1,9 +1,9 @@
 
+import collections
 import errno
 import hashlib
 import os
 import re
-import shutil
 import subprocess
 import time
 import unicodedata
@@ -12,14 +12,22 @@ import mutagen
 from mutagen.easyid3 import EasyID3
 from mutagen.mp3 import MP3
 
+import copyEngine
+import encoders
 import fileSource
+import metadataCache
 import trackHistory
+import workerPool
 
 kModes = ("copy", "move")
 kOnDupe = ("force", "skip", "ask")
 
-#                 0    1    2    3    4    5    6
-kVbrEquivalents = [245, 225, 190, 175, 165, 130, 115]
+# FileDestination.MusicAction() name for each of our music handlers.
+kHandlerActions = {"_DoTranscode": "transcode", "_DoCopy": "copy", "_DoMove": "move"}
+
+# average bitrate LAME produces at each of its -V quality settings.
+#                 0    1    2    3    4    5    6    7    8   9
+kVbrEquivalents = [245, 225, 190, 175, 165, 130, 115, 100, 85, 65]
 
 
 kMp3FileStrFormat = u'''Album Artist: {0.albumArtist}
@@ -38,6 +46,10 @@ Bitrate:      {0.bitrate}
 # instead of setting it to now.
 qReorganize = False
 
+# If set (see UseMetadataCache()), an instance of metadataCache.MetadataCache 
+# that Mp3File objects will use to avoid re-reading tags from unchanged files.
+mp3Cache = None
+
 
 class MetadataException(Exception):
    def __init__(self, txt):
@@ -54,11 +66,89 @@ class InvalidFileException(Exception):
 def NormalizeFilename(filename):
    return unicodedata.normalize('NFC', filename).encode('utf-8')
 
+def UseMetadataCache(dbPath):
+   ''' Start using a persistent metadata cache stored at dbPath for all of the 
+      Mp3File objects that we create from here on.
+   '''
+   global mp3Cache
+   CloseMetadataCache()
+   mp3Cache = metadataCache.MetadataCache(dbPath)
+   return mp3Cache
+
+def CloseMetadataCache():
+   ''' write any pending changes to the metadata cache & stop using it. '''
+   global mp3Cache
+   if mp3Cache:
+      mp3Cache.Close()
+      mp3Cache = None
+
 def TitleCase(s):
    words = s.split()
    return ' '.join(w.capitalize() for w in words)
 
 
+def Memoize(maxSize):
+   ''' Decorator that remembers the results of a function of hashable 
+      arguments, keeping (roughly) the maxSize most recently used ones. 
+      
+      Results go into a 'new' generation, which becomes the 'old' one when
+      it's full; anything in the old generation that isn't used again before 
+      the new one fills up is forgotten. This keeps a hit down to a single 
+      dict lookup (which matters when the function itself is cheap), and 
+      the worst that can happen if two threads race is that something gets
+      worked out twice.
+   >>> calls = []
+   >>> @Memoize(4)
+   ... def Double(x):
+   ...    calls.append(x)
+   ...    return 2 * x
+   >>> [Double(x) for x in (1, 2, 1, 3, 2, 1)]
+   [2, 4, 2, 6, 4, 2]
+   >>> calls
+   [1, 2, 3, 2]
+   '''
+   def Decorate(func):
+      generationSize = max(1, maxSize // 2)
+      # [new, old]
+      generations = [{}, {}]
+      def Memoized(*args):
+         new, old = generations
+         try:
+            return new[args]
+         except KeyError:
+            pass
+         try:
+            result = old[args]
+         except KeyError:
+            result = func(*args)
+         new[args] = result
+         if len(new) >= generationSize:
+            generations[:] = [{}, new]
+         return result
+      Memoized.__name__ = func.__name__
+      Memoized.__doc__ = func.__doc__
+      return Memoized
+   return Decorate
+
+
+# Album and artist names repeat for every track on an album, so there's no
+# point in cleaning them up more than once.
+kMemoSize = 4096
+
+# characters that we don't want in file or path names. Some get replaced 
+# with spaces, quotes and dots just disappear, and square brackets become 
+# parens -- they freak out other code of mine that uses glob to process file 
+# names.
+kScrubTable = dict((ord(c), u" ") for c in u":/\\?<>,!")
+kScrubTable.update((ord(c), None) for c in u"\"'.")
+kScrubTable.update({ord(u"["): u"(", ord(u"]"): u")"})
+
+# runs of whitespace and dashes, which all get replaced by a single dash. 
+# Only ASCII whitespace, as always: names with (e.g.) non-breaking spaces 
+# in them have to keep mapping to the same paths they always have.
+kDashes = re.compile(r"[ \t\n\r\f\v-]+")
+
+@Memoize(kMemoSize)
 def Scrub(s):
    '''
       1. convert the string into lowercase & strip outer whitespace
@@ -69,40 +159,31 @@ def Scrub(s):
       u'No-Illegal-characters'
       >>> Scrub(u"this: <should> /be\\ shorter?")
       u'this-should-be-shorter'
+      >>> Scrub(u" [Don't]  -  Stop... ")
+      u'(Dont)-Stop'
+      >>> Scrub("Sigur R\\xc3\\xb3s")
+      u'Sigur-R\\xf3s'
+      >>> Scrub(u"Buena\\xa0Vista Club")
+      u'Buena\\xa0Vista-Club'
 
    '''
-   #s = s.lower()
+   if isinstance(s, str):
+      s = s.decode("utf-8")
+   # (there can't be any trailing dots left to cause problems when this is 
+   # used as a directory name -- the table removes all of them.)
+   return kDashes.sub(u"-", s.translate(kScrubTable).strip())
 
-   kIllegals = u":/\\?<>,!"
-   # get rid of quotes/dots but don't leave space.
-   kIllegal2 = u"\"'."
-   try:
-      for c in kIllegals:
-         s = s.replace(c, u" ")
-      for c in kIllegal2:
-         s = s.replace(c, u"")
-
-      #  replace square brackets with parens -- they freak out other 
-      #  code of mine that uses glob to process file names.
-      s = s.replace('[', '(')
-      s = s.replace(']', ')')   
-      # replace multiple whitespace chars with a single space
-      s = re.sub("\s+", u" ", s)
-      # get rid of any whitespace on the outside
-      s = s.strip()
-      # replace each space w a dash
-      s = s.replace(u' ', u'-')
-      # replace multiple dashes with a single dash
-      s = re.sub("-+", u'-', s)
-      # Always get rid of any trailing dots -- this causes problems when 
-      # used as a directory name. 
-      s = s.rstrip('.')
-
-      return s
-   except UnicodeDecodeError, e:
-      return Scrub(s.decode("utf-8"))
+
+def Duration(length):
+   ''' convert a length in seconds to a MM:SS string.
+   >>> Duration(125.4)
+   u'2:05'
+   '''
+   duration = map(int, divmod(length, 60))
+   return u"{0[0]}:{0[1]:02}".format(duration)
 
 
+@Memoize(kMemoSize)
 def ArtistSort(s):
    '''
       Convert artist names that are in the form "The Beatles" to just "Beatles".
@@ -124,6 +205,44 @@ def ArtistSort(s):
          s = s[4:]
    return s
 
+def CopyTags(srcFile, destFile):
+   ''' Copy all of the ID3 frames in srcFile -- cover art, comments, lyrics
+      and anything else, not just the tags that EasyID3 knows about -- into 
+      the file at destFile, replacing any tags it has, with a single write.
+   >>> import shutil, tempfile
+   >>> from mutagen.id3 import ID3, TIT2, COMM, APIC
+   >>> tempDir = tempfile.mkdtemp()
+   >>> src, dest = os.path.join(tempDir, "src.mp3"), os.path.join(tempDir, "dest.mp3")
+   >>> open(src, "wb").close(); open(dest, "wb").close()
+   >>> tags = ID3()
+   >>> tags.add(TIT2(encoding=3, text=u"Song"))
+   >>> tags.add(COMM(encoding=3, lang="eng", desc=u"", text=u"Nice"))
+   >>> tags.add(APIC(encoding=3, mime="image/jpeg", type=3, desc=u"", data="jpg"))
+   >>> tags.save(src)
+   >>> CopyTags(src, dest)
+   >>> copied = ID3(dest)
+   >>> sorted(frame.FrameID for frame in copied.values())
+   ['APIC', 'COMM', 'TIT2']
+   >>> copied.getall("APIC")[0].data
+   'jpg'
+   >>> shutil.rmtree(tempDir)
+   '''
+   try:
+      tags = mutagen.id3.ID3(srcFile)
+   except mutagen.id3.ID3NoHeaderError:
+      # nothing to copy.
+      return
+   tags.save(destFile)
+
+@Memoize(kMemoSize)
+def AlbumPath(artist, albumName):
+   ''' the Artist/Year_Album directory for an album. 
+   >>> AlbumPath(u"Kneebody", u"2008_Low Electrical Worker")
+   u'Kneebody/2008_Low-Electrical-Worker'
+   '''
+   return os.path.join(Scrub(artist), Scrub(albumName))
+
+
 class Metadata(object):
    def __init__(self, id3):
       ''' id3 is probably an instance of mutagen.easyid3.EasyId3 '''
@@ -159,25 +278,51 @@ class Metadata(object):
 
 class Mp3File(object):
    def __init__(self, pathToFile, metadata=None):
+      self.path = pathToFile
+      self._meta = None
+
+      # if we have a metadata cache and this file hasn't changed since we
+      # last saw it, we don't need to open the file at all.
+      st = None
+      if not metadata and mp3Cache:
+         try:
+            st = os.stat(pathToFile)
+            fields = mp3Cache.Get(pathToFile, st.st_size, st.st_mtime)
+            if fields:
+               self.SetFields(fields)
+               return
+         except OSError:
+            # let the normal parsing code report the problem.
+            st = None
+
+      audio = None
       if not metadata:
          try:
-            id3 = EasyID3(pathToFile)
-         except mutagen.id3.ID3NoHeaderError as e:
-            raise MetadataException(str(e))
-
+            # read the tags and the stream info in a single pass.
+            audio = MP3(pathToFile, ID3=EasyID3)
+            id3 = audio.tags
+         except IOError:
+            # no usable MPEG stream in this file, but there may still be
+            # tags that we can use.
+            id3 = None
+            try:
+               id3 = EasyID3(pathToFile)
+            except mutagen.id3.ID3NoHeaderError as e:
+               raise MetadataException(str(e))
+         if id3 is None:
+            raise MetadataException(
+               "{0!r} doesn't start with an ID3 tag".format(pathToFile))
       else:
          id3 = metadata
-      self.meta = Metadata(id3)
+      self._meta = Metadata(id3)
 
       try:
-         audio = MP3(pathToFile)
+         if audio is None:
+            audio = MP3(pathToFile)
          self.bitrate = audio.info.bitrate / 1000
-         # length is in seconds
-         length = audio.info.length
-         duration = map(int, divmod(length, 60))
-         # length is in seconrds, duration is in MM:SS time (string)
-         self.length = length
-         self.duration = u"{0[0]}:{0[1]:02}".format(duration)
+         # length is in seconds, duration is in MM:SS time (string)
+         self.length = audio.info.length
+         self.duration = Duration(self.length)
       except (IOError, AttributeError):
          # fake it.
          self.bitrate = 128
@@ -263,6 +408,56 @@ class Mp3File(object):
       if not self.title:
          self.title = baseName
 
+      if st:
+         mp3Cache.Put(pathToFile, st.st_size, st.st_mtime, self.Fields())
+
+   @property
+   def meta(self):
+      ''' The raw ID3 metadata. If we were created from the metadata cache, we 
+         only load the tags from the file if someone actually needs them.
+      '''
+      if self._meta is None:
+         try:
+            self._meta = Metadata(EasyID3(self.path))
+         except mutagen.id3.ID3NoHeaderError as e:
+            raise MetadataException(str(e))
+      return self._meta
+
+   def Fields(self):
+      ''' return a dict with the values of all the attributes that we derive 
+         from the file's metadata.
+      >>> d1 = {"artist" : ["Kneebody"], "album": ["Low Electrical Worker"], "date": ["2008"]}
+      >>> f = Mp3File('', d1).Fields()
+      >>> f['albumArtist'], f['bitrate'], f['compilation']
+      ('Kneebody', 128, False)
+      '''
+      return dict((field, getattr(self, field)) for field in 
+         metadataCache.kCachedFields)
+
+   @classmethod
+   def FromFields(cls, pathToFile, fields):
+      ''' create an Mp3File for pathToFile from a dict of previously derived 
+         values (see Fields()) without reading the file.
+      '''
+      mp3 = cls.__new__(cls)
+      mp3.path = pathToFile
+      mp3._meta = None
+      mp3.SetFields(fields)
+      return mp3
+
+   def SetFields(self, fields):
+      ''' Set our attributes from a dict like the one returned by Fields()
+      >>> d1 = {"artist" : ["Kneebody"], "album": ["Low Electrical Worker"], "date": ["2008"]}
+      >>> fields = Mp3File('', d1).Fields()
+      >>> m = Mp3File.FromFields('', fields)
+      >>> m.DestPath()
+      u'Kneebody/2008_Low-Electrical-Worker'
+      '''
+      for field in metadataCache.kCachedFields:
+         setattr(self, field, fields[field])
+      self.compilation = bool(self.compilation)
+      self.duration = Duration(self.length)
+
    def __str__(self):
       return kMp3FileStrFormat.format(self).encode("utf-8")
 
@@ -318,7 +513,7 @@ class Mp3File(object):
       u'Beatles/1965_Rubber-Soul'
       '''
 
-      return os.path.join(Scrub(self.albumArtist), Scrub(self.DestAlbumName()))
+      return AlbumPath(self.albumArtist, self.DestAlbumName())
 
 
    def DestFile(self):
@@ -353,7 +548,7 @@ class Mp3File(object):
 
 class FileDestination(object):
    def __init__(self, baseDir, mode="copy", onDupe="force", rate="0", 
-         musicOnly=False, cleanUp=False, debug=False):
+         musicOnly=False, cleanUp=False, debug=False, jobs=1, stream=False):
       """
       >>> f = FileDestination(".", "copy", "force", "V4")
       >>> f.vbr
@@ -373,20 +568,62 @@ class FileDestination(object):
       self.musicOnly = musicOnly
       self.cleanUp = cleanUp
       self.debug = debug
+      # if True, we pipe the source through LAME and write the tags ourselves
+      # instead of letting LAME read the file and tag the output.
+      self.stream = stream
 
       # we need to handle VBR separately from 
       self.vbr = False
       if rate.lower().startswith('v'):
-         # VBR rates will be specified as 'V0'..'V6'. 
+         # VBR rates will be specified as 'V0'..'V9'. 
          self.vbr = True
          rate = rate[1:]
 
       self.rate = int(rate)
+      if self.vbr and not 0 <= self.rate < len(kVbrEquivalents):
+         raise ValueError("LAME's VBR quality levels are V0..V9, not V{0}".format(self.rate))
 
       self.moveDate = int(time.time())
 
       self.currentOutputDir = ""
 
+      # list of (srcFile, error message) tuples for every music file that we 
+      # failed to handle.
+      self.failures = []
+      # if set, called as onMusicDone(path, success) for each music file as we 
+      # finish with it (successfully or not) so that the caller can track 
+      # progress. Files we skip count as successes.
+      self.onMusicDone = None
+
+      # history files we're in the middle of updating.
+      self.historySession = trackHistory.HistorySession()
+
+      # if set, a transferJournal.Journal that we record each music file in as
+      # we finish it, and use to skip files that an earlier run already did.
+      self.journal = None
+      self.resumed = 0
+      # (src, dest, size, mtime) for files that we've finished with but whose
+      # history changes are still waiting in the session; we don't tell the 
+      # journal they're done until those changes have been written.
+      self.journalPending = []
+
+      # how many music files we handled each way ('transcode', 'copy', etc.)
+      self.summary = collections.Counter()
+
+      # the encoder backend we transcode with. We don't pick one until we 
+      # have our first file to transcode (so we can measure them with it.)
+      self.encoders = encoders.Registry()
+      self.encoder = None
+
+      # does our copies and moves, and keeps count of how it did them.
+      self.copier = copyEngine.CopyEngine()
+
+      # Transcoding is CPU bound and happens in a separate LAME process, so 
+      # if we were asked to, we run several of them at once.
+      self.pool = None
+      if jobs > 1 and not self.debug:
+         self.pool = workerPool.WorkerPool(jobs)
+
       if self.mode == "copy":
          if self.vbr or (self.rate > 0):
             self.MusicHandler = self._DoTranscode
@@ -423,21 +660,82 @@ class FileDestination(object):
                raise
 
 
+   def TargetBitrate(self):
+      ''' the bitrate (in kbps) that we're transcoding to. For VBR we use the
+         average rate that LAME produces at that quality setting.
+      >>> FileDestination(".", "copy", "force", "160").TargetBitrate()
+      160
+      >>> FileDestination(".", "copy", "force", "V2").TargetBitrate()
+      190
+      >>> FileDestination(".", "copy", "force", "V9").TargetBitrate()
+      65
+      '''
+      if self.vbr:
+         return kVbrEquivalents[self.rate]
+      return self.rate
+
+   def SelectEncoder(self, sampleFile=None):
+      ''' Pick the fastest encoder backend that can produce our target rate,
+         measuring them on sampleFile if we haven't before. If there's nothing 
+         on this machine that can transcode, we copy music files as they are.
+      '''
+      self.encoder = self.encoders.Choose(self.rate, self.vbr, 
+         None if self.debug else sampleFile)
+      if self.encoder is None:
+         print "WARNING: no encoder available to transcode to {0}{1}; copying files instead.".format(
+            "V" if self.vbr else "", self.rate)
+         self.encoder = encoders.CopyEncoder()
+         self.MusicHandler = self._DoCopy
+      else:
+         print "Transcoding with {0}.".format(self.encoder.name)
+      return self.encoder
+
+   def ChooseMusicHandler(self, mp3):
+      ''' Return the handler method to use for this music file. We only 
+         transcode to lower bitrates -- if the file is already at or below our 
+         target rate, we copy it as is.
+      >>> f = FileDestination(".", "copy", "force", "160")
+      >>> class Track(object): pass
+      >>> t = Track()
+      >>> t.bitrate = 128
+      >>> f.ChooseMusicHandler(t).__name__
+      '_DoCopy'
+      >>> t.bitrate = 320
+      >>> f.ChooseMusicHandler(t).__name__
+      '_DoTranscode'
+      '''
+      if self.MusicHandler == self._DoTranscode and mp3.bitrate <= self.TargetBitrate():
+         return self._DoCopy
+      return self.MusicHandler
+
    def MusicLocation(self, pathToSrcFile):
       ''' return the expected location of this mp3 file based on its metadata. '''
-      m = Mp3File(pathToSrcFile)
-      destPath = m.DestPath()
-      destFile = m.DestFile()
+      return self.MusicDestination(Mp3File(pathToSrcFile))
 
-      retval = False
-      destPath = os.path.join(self.baseDir, destPath, destFile) 
-      return destPath
+   def MusicDestination(self, mp3):
+      ''' return the full path that an Mp3File object should be written to. '''
+      return os.path.join(self.baseDir, mp3.DestPath(), mp3.DestFile())
 
-   def HandleFile(self, type, pathToFile):
+   def MusicAction(self, mp3, destFile):
+      ''' Describe what HandleMusic() will do with this file without doing it: 
+         one of 'transcode', 'copy', 'move', or 'skip' (if the destination 
+         already exists and we're not replacing existing files.) 
+      '''
+      if self.onDupe == "skip" and os.path.exists(destFile):
+         return "skip"
+      if self.MusicHandler == self._DoTranscode and self.encoder is None:
+         # we may not be able to transcode after all; find out before we 
+         # say that we will.
+         self.SelectEncoder(mp3.path)
+      return kHandlerActions[self.ChooseMusicHandler(mp3).__name__]
+
+   def HandleFile(self, type, pathToFile, mp3=None):
       '''
          type -- one of fileSource.kDirectory, fileSource.kMusic, or 
          fileSource.kOtherFile.
          pathToFile -- full path to the existing source file.
+         mp3 -- for music files, an Mp3File object for the file if we already
+         have one (e.g. from a transfer plan.)
 
          returns True/False to indicate the success/fail whether this file 
          was handled.
@@ -453,7 +751,9 @@ class FileDestination(object):
       print "Handling {0}: {1}".format(type, pathToFile.encode("utf-8"))
       handler = handlers.get(type, None)
       retval = False
-      if handler:
+      if fileSource.kMusic == type:
+         retval = self.HandleMusic(pathToFile, mp3)
+      elif handler:
          retval = handler(pathToFile)
       else:
          ### !!! log the weirdness
@@ -462,16 +762,19 @@ class FileDestination(object):
       return retval
 
 
-   def _DoMove(self, srcFile, destFile):
+   def _DoMove(self, srcFile, destFile, mp3=None):
       ''' move the file from its current location to its new destination.'''
       if self.debug:
          print "MOVING\n{0}\nto\n{1}".format(srcFile, destFile)
       else:
-         shutil.move(srcFile, destFile)
-      # !!! Need to account for potential exceptions here. 
+         try:
+            self.copier.Move(srcFile, destFile)
+         except (IOError, OSError), e:
+            print str(e)
+            return False
       return True
 
-   def _DoCopy(self, srcFile, destFile):
+   def _DoCopy(self, srcFile, destFile, mp3=None):
       ''' simple copy from src-->dest. No rate change of MP3 files. '''
       retval = True
       if self.debug:
@@ -480,59 +783,33 @@ class FileDestination(object):
          print "COPYING\n{0}\nto\n{1}".format(srcFile, destFile)
       else:
          try:
-            shutil.copyfile(srcFile, destFile)
-         except IOError, e:
+            self.copier.Copy(srcFile, destFile)
+         except (IOError, OSError), e:
             print str(e)
             retval = False
       return retval
 
-   def _DoTranscode(self, srcFile, destFile):
+   def _DoTranscode(self, srcFile, destFile, mp3=None):
       ''' create a new copy of the srcFile at destFile, changing its encoding
-         bit rate as we go. Requires that LAME is installed.
+         bit rate as we go using our encoder backend (LAME, ffmpeg...)
+
+         mp3 is the already-parsed Mp3File for srcFile, if the caller has one.
       '''
 
       retval = False
-      original = Mp3File(srcFile)
-
-      # !!!TODO: compare rate of source file; if it's less than what our
-      # target rate is, copy the file as is instead of transcoding. We only
-      # transcode to lower bitrates.
+      original = mp3 or Mp3File(srcFile)
+      encoder = self.encoder or self.SelectEncoder(srcFile)
+      if isinstance(encoder, encoders.CopyEncoder):
+         # nothing here can transcode.
+         return self._DoCopy(srcFile, destFile, original)
 
-      cmd = ['lame', '-h']
-      rateString  = "{0}".format(self.rate)
-      if self.vbr:
-         cmd.extend(["-V", rateString])
-      else:
-         cmd.extend(["-b", rateString])
-
-      ## make sure that the metadata gets put in the new file correctly.
-      cmd.append("--id3v2-only")
-      # a list of tuples where
-      # [0] is the command line flag to pass to LAME
-      # [1] is the attribute name inside of the mutagen ID3 object.
-      kFields = [ ("--tt", "title"),
-                  ("--ta", "artist"),
-                  ("--tl", "album"),
-                  ("--ty", "year"),
-                  ("--tn", "trackNum"),
-                  ("--tg", "genre")
-                 ]
-
-      for (flag, field) in kFields:
-         try:
-            val = getattr(original, field)
-            # apparently there's some chance of bogus leading/trailing 
-            # double quotes?
-            val = val.strip('"')
-            if val:
-               cmd.extend([flag, u'{0}'.format(val)])
-         except AttributeError:
-            # that metadata field is missing from this file; skip it.
-            pass
+      if self.stream:
+         cmd = encoder.StreamCommand(self.rate, self.vbr)
+         if cmd:
+            return self._StreamTranscode(cmd, srcFile, destFile)
 
-      # okay, all the metadata & other args are set. Pass in the src & dest 
-      # values and make this go.       
-      cmd.extend(['--mp3input', srcFile, destFile])
+      # the encoder puts the metadata into the new file correctly.
+      cmd = encoder.Command(self.rate, self.vbr, srcFile, destFile, original)
 
       #try:
       #   print u" ".join(cmd)
@@ -551,6 +828,30 @@ class FileDestination(object):
          retval = result == 0
       return retval
 
+   def _StreamTranscode(self, cmd, srcFile, destFile):
+      ''' Feed the source file to the encoder on its stdin and send its stdout 
+         straight into destFile, then write all of the original file's tags 
+         (not just the ones LAME has command line flags for) in one go.
+
+         cmd is the encoder's command line for reading stdin & writing stdout.
+      '''
+      if self.debug:
+         print u"\n\nTRANSCODING (streamed)\n{0}\nto\n{1}\nwith command line\n{2}\n".format(
+            srcFile, destFile, u" ".join(cmd))
+         return True
+
+      with open(srcFile, "rb") as src:
+         with open(destFile, "wb") as dest:
+            result = subprocess.call(cmd, stdin=src, stdout=dest)
+      if result != 0:
+         return False
+      try:
+         CopyTags(srcFile, destFile)
+      except (MetadataException, mutagen.id3.error, IOError) as e:
+         print "ERROR writing tags to {0}: {1}".format(destFile.encode("utf-8"), e)
+         return False
+      return True
+
       
 
    def ReplaceExisting(self, srcFile, destFile):
@@ -607,6 +908,8 @@ class FileDestination(object):
 
    def HandleExitDir(self, path):
       ''' maybe clean up empty directories after we're done moving? '''
+      # we're done with this directory; write out its history changes.
+      self.FlushHistory()
       if self.cleanUp and ("move" == self.mode):
          # check to see if this directory has been emptied..
          if not os.listdir(path):
@@ -614,31 +917,116 @@ class FileDestination(object):
             os.rmdir(path)
       return True
 
-   def HandleMusic(self, path):
+   def HandleMusic(self, path, mp3=None):
       ''' the File Source is sending us a new music file. '''
-      m = Mp3File(path)
+      srcStat = None
+      if self.journal:
+         srcStat = os.stat(path)
+         doneDest = self.journal.Completed(path, srcStat.st_size, srcStat.st_mtime)
+         if doneDest:
+            # an earlier run already took care of this one. We still need to 
+            # know where its directory went so other files can follow it.
+            if os.path.dirname(doneDest) != self.currentOutputDir:
+               self.FlushHistory()
+               self.currentOutputDir = os.path.dirname(doneDest)
+            self.resumed += 1
+            self.MusicDone(path, doneDest, True, skipped=True)
+            return True
+
+      m = mp3 or Mp3File(path)
       destPath = m.DestPath()
       destFile = m.DestFile()
 
       retval = False
       destPath = os.path.join(self.baseDir, destPath)
       if destPath != self.currentOutputDir:
-         # writing to a new directory. Make sure that it exists.
+         # writing to a new directory. Write out the history changes for the 
+         # directory we were working on, and make sure that the new one exists.
+         self.FlushHistory()
          self.currentOutputDir = destPath
          try:
             self.PrepDestination()
          except IOError, e:
             print "ERROR creating destination directory {0}".format(destPath)
+            self.MusicDone(path, destPath, False, e)
             return False
       destPath = os.path.join(destPath, destFile)
       if self.ReplaceExisting(path, destPath):
-         # ...where MusicHandler is one of _DoCopy, _DoTranscode, _DoMove
-         if self.MusicHandler(path, destPath):
+         if self.MusicHandler == self._DoTranscode and self.encoder is None:
+            self.SelectEncoder(path)
+         # ...where handler is one of _DoCopy, _DoTranscode, _DoMove
+         handler = self.ChooseMusicHandler(m)
+         self.summary[kHandlerActions[handler.__name__]] += 1
+         if self.journal:
+            self.journal.Begin(path, destPath)
+         if self.pool and handler == self._DoTranscode:
+            # let a worker thread run LAME; we'll update the history when 
+            # it's done.
+            def OnDone(result, error):
+               self.MusicDone(path, destPath, result, error, srcStat=srcStat)
+            self.pool.Submit(handler, (path, destPath, m), OnDone)
             retval = True
-            self.UpdateHistory(path, destPath)
+         else:
+            retval = handler(path, destPath, m)
+            self.MusicDone(path, destPath, retval, srcStat=srcStat)
+      else:
+         # skipping this file isn't a failure.
+         self.summary["skip"] += 1
+         self.MusicDone(path, destPath, True, skipped=True)
       return retval
 
 
+   def MusicDone(self, srcFile, destFile, success, error=None, skipped=False, 
+         srcStat=None):
+      ''' Called (always on the thread that's calling HandleMusic()) when we're
+         finished with a music file. With a worker pool, transcodes finish in 
+         the order they were handed to us, but files that we copy or skip are 
+         done right away -- possibly before transcodes that we were given 
+         earlier. (None of the history is written until the pool has caught 
+         up; see FlushHistory().) srcStat is the result of os.stat() on the 
+         source file from before we handled it, if we're keeping a journal.
+      '''
+      if skipped:
+         pass
+      elif success:
+         self.UpdateHistory(srcFile, destFile)
+         if self.journal and not self.debug:
+            self.journalPending.append((srcFile, destFile, srcStat.st_size, 
+               srcStat.st_mtime))
+      else:
+         if error is None:
+            error = "unable to {0} to {1}".format(self.mode, destFile.encode("utf-8"))
+         self.failures.append((srcFile, str(error)))
+      if self.onMusicDone:
+         self.onMusicDone(srcFile, success)
+
+
+   def Finish(self):
+      ''' Wait for any work that's still in progress to complete. Call this once
+         after the last file has been handed to us.
+      '''
+      if self.pool:
+         self.pool.Close()
+         self.pool = None
+      self.FlushHistory()
+
+
+   def FlushHistory(self):
+      ''' Write out the history changes we've been saving up, and only then 
+         record the files they belong to as done in the journal -- if we die 
+         before the history is written, a resumed run has to do them again.
+      '''
+      if self.pool:
+         # wait for the transcodes that are still running, so their history 
+         # changes go out with this flush instead of making us load and save 
+         # the same history file again later.
+         self.pool.Drain()
+      self.historySession.Flush()
+      for (src, dest, size, mtime) in self.journalPending:
+         self.journal.Done(src, dest, size, mtime)
+      self.journalPending = []
+
+
    def UpdateHistory(self, srcFile, destFile):
       ''' If we're moving a track from a maintained directory to a new directory, 
          make sure that the history file at the destination is updated with the 
@@ -649,9 +1037,10 @@ class FileDestination(object):
          srcPath, srcTrack = os.path.split(srcFile)
          destPath, destTrack = os.path.split(destFile)
 
-         # load up the history files, neither of which may actually exist!
-         srcHistory = trackHistory.History(srcPath)
-         destHistory = trackHistory.History(destPath)
+         # load up the history files, neither of which may actually exist! 
+         # These get saved when the session is flushed.
+         srcHistory = self.historySession.Get(srcPath)
+         destHistory = self.historySession.Get(destPath)
 
          # ...and update the destination history using the contents of the 
          # source history.
@@ -660,7 +1049,6 @@ class FileDestination(object):
             move = self.moveDate
 
          destHistory.AddTrack(destTrack, acq, move)
-         destHistory.Save()
 
 
 
@@ -1,14 +1,75 @@
 
 import os
 
+# os.scandir() is only in the standard library as of Python 3.5; the `scandir` 
+# package on PyPI backports it. If neither is available, we fall back to 
+# os.listdir() + os.path.isdir().
+try:
+   from os import scandir
+except ImportError:
+   try:
+      from scandir import scandir
+   except ImportError:
+      scandir = None
+
 kDirectory = "DIR"
 kExitDirectory = "RID"
 kMusic = "MP3"
 kOtherFile = "ETC"
 
+def ListdirEntries(d):
+   ''' Return two lists (subdirectories, files) of the full paths of the items
+      in directory `d`. This needs an extra stat() call for each item to tell 
+      directories and files apart.
+   '''
+   dirs = []
+   files = []
+   for item in os.listdir(d):
+      fullpath = os.path.join(d, item)
+      if os.path.isdir(fullpath):
+         dirs.append(fullpath)
+      else:
+         files.append(fullpath)
+   return dirs, files
+
+
+def ScandirEntries(d):
+   ''' Same as ListdirEntries(), but uses the file type that the OS returns 
+      with each directory entry when it can, which saves a stat() call per 
+      item on most filesystems (a big deal over SMB/NFS.)
+   '''
+   dirs = []
+   files = []
+   for entry in scandir(d):
+      fullpath = os.path.join(d, entry.name)
+      try:
+         isDir = entry.is_dir()
+      except OSError:
+         isDir = False
+      if isDir:
+         dirs.append(fullpath)
+      else:
+         files.append(fullpath)
+   return dirs, files
+
+
+kListers = {"listdir": ListdirEntries}
+if scandir:
+   kListers["scandir"] = ScandirEntries
+   kDefaultLister = "scandir"
+else:
+   kDefaultLister = "listdir"
+
+
 class FileSource(object):
-   def __init__(self, base, others=None):
+   def __init__(self, base, others=None, lister=None):
       '''
+         base -- top-level directory that we're working with. 
+         others -- list of subdirectories of base (or the name of a file 
+            listing them) to look at instead of the whole of base.
+         lister -- which of kListers to use when reading directories; by 
+            default we use the fastest one that's available. 
+
       >>> f = FileSource('/a/b/c', ['d', ' e ', '   ', 'g '])
       >>> f.base
       '/a/b/c'
@@ -17,6 +78,7 @@ class FileSource(object):
 
       '''
       self.base = base
+      self.ListEntries = kListers[lister or kDefaultLister]
       if others is None:
          self.others = ['']
       else:
@@ -84,20 +146,16 @@ class FileSource(object):
             print "{0} isn't a directory!".format(d).encode("utf-8")
             assert False
 
-         dirs = []
-         files = []
          # notify that we're entering a directory.
          yield (kDirectory, d)
          # ...then look at all of the items that are in this directory, sorting into 
          # two lists -- files and directories. 
-         for item in os.listdir(d):
-            fullpath = os.path.join(d, item)
-            if os.path.isdir(fullpath):
-               if fullpath not in visited:
-                  dirs.append(fullpath)
-                  visited.add(fullpath)
-            else:
-               files.append(fullpath)
+         subdirs, files = self.ListEntries(d)
+         dirs = []
+         for fullpath in subdirs:
+            if fullpath not in visited:
+               dirs.append(fullpath)
+               visited.add(fullpath)
 
          otherFiles = []
          files.sort()
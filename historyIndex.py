@@ -0,0 +1,224 @@
+#! /usr/bin/env python
+
+'''
+   A library-wide index of the per-album track history files.
+
+   The .tracks files in each album directory stay the source of truth (they
+   move around with the music), but answering questions like "which tracks
+   were acquired in the last 30 days?" from them means opening every one of
+   them. This keeps a copy of all of their contents in a single SQLite
+   database at the top of the library, where those questions are a single
+   indexed query.
+
+   The index is kept up to date in two ways:
+   - Attach() it, and every trackHistory.History object that's saved inside
+     the library updates the index as it's written.
+   - Sync() checks the modification time of every album's history file and
+     reloads the ones that have changed since we last looked (e.g. because
+     they were written by some other machine.)
+'''
+
+import errno
+import os
+import sqlite3
+import threading
+
+import fileSource
+import trackHistory
+
+kIndexFileName = u".history.db"
+
+kSchema = '''
+CREATE TABLE IF NOT EXISTS tracks (
+   artist TEXT,
+   album TEXT,
+   track TEXT,
+   acquired INTEGER,
+   moved INTEGER,
+   PRIMARY KEY (artist, album, track)
+);
+CREATE INDEX IF NOT EXISTS tracksByAcquired ON tracks (acquired);
+CREATE INDEX IF NOT EXISTS tracksByMoved ON tracks (moved);
+CREATE TABLE IF NOT EXISTS albums (
+   artist TEXT,
+   album TEXT,
+   mtime REAL,
+   PRIMARY KEY (artist, album)
+);
+'''
+
+# database column for each of the dates in a history entry.
+kDateColumns = {
+   trackHistory.kAcqDate : "acquired",
+   trackHistory.kMoveDate : "moved"
+}
+
+
+def IndexPath(libPath):
+   ''' default location of the index for a library.
+   >>> IndexPath(u'/music')
+   u'/music/.history.db'
+   '''
+   return os.path.join(libPath, kIndexFileName)
+
+
+class HistoryIndex(object):
+   def __init__(self, libPath, dbPath=None):
+      '''
+         libPath -- top of the library (the directory containing the artist
+            directories)
+         dbPath -- where to keep the database; defaults to IndexPath(libPath)
+      '''
+      self.libPath = os.path.abspath(libPath)
+      self.dbPath = dbPath or IndexPath(libPath)
+      # we may be the first thing to write into a new library.
+      try:
+         os.makedirs(os.path.dirname(os.path.abspath(self.dbPath)))
+      except OSError, e:
+         if e.errno != errno.EEXIST:
+            raise
+      self.lock = threading.Lock()
+      self.db = sqlite3.connect(self.dbPath, check_same_thread=False)
+      self.db.executescript(kSchema)
+
+   def Close(self):
+      self.Detach()
+      with self.lock:
+         self.db.commit()
+         self.db.close()
+
+   def Attach(self):
+      ''' start updating the index whenever a history file is saved. '''
+      if self.UpdateAlbum not in trackHistory.saveHooks:
+         trackHistory.saveHooks.append(self.UpdateAlbum)
+
+   def Detach(self):
+      if self.UpdateAlbum in trackHistory.saveHooks:
+         trackHistory.saveHooks.remove(self.UpdateAlbum)
+
+   def _AlbumKey(self, history):
+      ''' return the (artist, album) names for a History object if it belongs
+         to our library, otherwise None.
+      '''
+      albumPath = os.path.dirname(os.path.abspath(history.filePath))
+      artistPath = os.path.dirname(albumPath)
+      if os.path.dirname(artistPath) != self.libPath:
+         return None
+      return (history.artistName, history.albumName)
+
+   def UpdateAlbum(self, history):
+      ''' replace everything we know about an album with the contents of a
+         History object.
+      '''
+      if self._ReplaceAlbum(history):
+         with self.lock:
+            self.db.commit()
+
+   def _ReplaceAlbum(self, history):
+      ''' does the work for UpdateAlbum() without committing. Returns True if 
+         the album was in our library.
+      '''
+      key = self._AlbumKey(history)
+      if key is None:
+         return False
+      artist, album = key
+      try:
+         mtime = os.stat(history.filePath).st_mtime
+      except OSError:
+         # the history file was deleted because it's now empty.
+         mtime = None
+      rows = [(artist, album, track, dates[trackHistory.kAcqDate],
+         dates[trackHistory.kMoveDate]) for (track, dates) in history.history.items()]
+      with self.lock:
+         self.db.execute("DELETE FROM tracks WHERE artist=? AND album=?", key)
+         self.db.executemany("INSERT INTO tracks VALUES (?,?,?,?,?)", rows)
+         if mtime is None:
+            self.db.execute("DELETE FROM albums WHERE artist=? AND album=?", key)
+         else:
+            self.db.execute("INSERT OR REPLACE INTO albums VALUES (?,?,?)",
+               (artist, album, mtime))
+      return True
+
+   def RemoveAlbum(self, artist, album):
+      with self.lock:
+         self.db.execute("DELETE FROM tracks WHERE artist=? AND album=?",
+            (artist, album))
+         self.db.execute("DELETE FROM albums WHERE artist=? AND album=?",
+            (artist, album))
+
+   def Sync(self):
+      ''' Bring the index up to date with the history files in the library,
+         reloading only the ones that have changed. Returns the number of
+         albums that were updated or removed.
+      '''
+      with self.lock:
+         known = dict(((artist, album), mtime) for (artist, album, mtime) in
+            self.db.execute("SELECT artist, album, mtime FROM albums"))
+
+      ListEntries = fileSource.kListers[fileSource.kDefaultLister]
+      changed = 0
+      artistDirs, _ = ListEntries(self.libPath)
+      for artistDir in artistDirs:
+         albumDirs, _ = ListEntries(artistDir)
+         for albumDir in albumDirs:
+            try:
+               mtime = os.stat(trackHistory.HistoryFilePath(albumDir)).st_mtime
+            except OSError:
+               # no history file in this directory.
+               continue
+            key = (os.path.basename(artistDir), os.path.basename(albumDir))
+            if known.pop(key, None) != mtime:
+               self._ReplaceAlbum(trackHistory.History(albumDir))
+               changed += 1
+
+      # anything left over has disappeared from the library.
+      for (artist, album) in known:
+         self.RemoveAlbum(artist, album)
+         changed += 1
+      with self.lock:
+         self.db.commit()
+      return changed
+
+   def TracksAfter(self, timeStamp, dateType=trackHistory.kAcqDate):
+      ''' return a sorted list of the 'artist/album/track' paths of the tracks
+         acquired (or moved) at or after `timeStamp`.
+      '''
+      query = "SELECT artist, album, track FROM tracks WHERE {0} >= ?".format(
+         kDateColumns[dateType])
+      with self.lock:
+         rows = self.db.execute(query, (timeStamp,)).fetchall()
+      return sorted(os.path.join(*row) for row in rows)
+
+
+   def Dates(self, dateType=trackHistory.kAcqDate):
+      ''' return {full path to track : date acquired (or moved)} for every 
+         track in the index, in one query.
+      '''
+      query = "SELECT artist, album, track, {0} FROM tracks".format(
+         kDateColumns[dateType])
+      with self.lock:
+         rows = self.db.execute(query).fetchall()
+      return dict((os.path.join(self.libPath, artist, album, track), date) 
+         for (artist, album, track, date) in rows)
+
+
+if __name__ == "__main__":
+   import argparse
+   import sys
+   parser = argparse.ArgumentParser("Update the history index at the top of a music library.")
+   parser.add_argument("-t", "--test", action='store_true',
+      help ="run unit tests (other options ignored)")
+   parser.add_argument("-s", "--src", action="store", nargs="?",
+      default=os.getcwd(), help="root directory of music collection.")
+
+   args = parser.parse_args()
+   if args.test:
+      import doctest
+      print "running module tests."
+      doctest.testmod()
+      print "done."
+      sys.exit(0)
+
+   index = HistoryIndex(unicode(args.src))
+   print "{0} albums updated.".format(index.Sync())
+   index.Close()
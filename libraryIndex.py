@@ -0,0 +1,299 @@
+#! /usr/bin/env python
+
+'''
+   A compact binary alternative to the JSON library files written by
+   ScanLibrary.
+
+   The file is laid out in columns of fixed-size records so that it can be
+   memory mapped and queried (e.g. "what are the tracks on this album?")
+   without parsing the whole thing:
+
+   header      magic, then the count and file offset of each of the tables below
+   strings     a table of (offset, length) pairs into a blob of UTF-8 text.
+               Every string in the library (names, tag values) is stored
+               once and referred to everywhere else by its index.
+   albums      one record per album: artist & album string ids, the album
+               directory's mtime, and the range of its tracks in the track
+               table. Sorted by (artist, album) so we can binary search it.
+   tracks      one record per track: the track name and each of its string
+               attributes as string ids, plus its bitrate and its acquired/
+               moved timestamps.
+
+   We can convert to and from the nested dict layout that ScanLibrary uses
+   (and writes as JSON).
+'''
+
+import bisect
+import mmap
+import os
+import struct
+
+kMagic = "MP3IDX01"
+kIndexExtension = ".mp3idx"
+
+# these are the same keys that ScanLibrary uses.
+kLastModified = "__mtime"
+kStringAttributes = ("artist", "trackArtist", "album", "title", "trackNum",
+   "year", "discNumber", "genre", "duration")
+
+# string id that stands for None.
+kNone = 0xFFFFFFFF
+# acquired/moved timestamp that stands for None.
+kNoTime = -1
+
+# magic, then (count, offset) for strings, albums, tracks, and the offset of
+# the string blob.
+kHeader = struct.Struct("<8s7Q")
+kStringRecord = struct.Struct("<QI")
+# artist id, album id, mtime, first track, track count
+kAlbumRecord = struct.Struct("<IIdII")
+# name id, string attribute ids, bitrate, acquired, moved
+kTrackRecord = struct.Struct("<I{0}Iiqq".format(len(kStringAttributes)))
+
+
+class IndexFormatError(Exception):
+   pass
+
+
+def IsIndexFile(path):
+   ''' True if the file at `path` is one of our binary index files. '''
+   try:
+      with open(path, "rb") as f:
+         return f.read(len(kMagic)) == kMagic
+   except IOError:
+      return False
+
+
+def _Names(d):
+   return sorted(k for k in d if not k.startswith("__"))
+
+
+def WriteIndex(library, path):
+   ''' Write a library dict (in the ScanLibrary layout) to a binary index file
+      at `path`.
+   '''
+   strings = []
+   stringIds = {}
+   def Intern(s):
+      if s is None:
+         return kNone
+      if isinstance(s, str):
+         s = s.decode("utf-8")
+      try:
+         return stringIds[s]
+      except KeyError:
+         stringIds[s] = len(strings)
+         strings.append(s)
+         return stringIds[s]
+
+   def Time(t):
+      return kNoTime if t is None else int(t)
+
+   albums = []
+   tracks = []
+   for artistName in _Names(library):
+      artist = library[artistName]
+      for albumName in _Names(artist):
+         album = artist[albumName]
+         trackNames = _Names(album)
+         albums.append(kAlbumRecord.pack(Intern(artistName), Intern(albumName),
+            album.get(kLastModified, 0), len(tracks), len(trackNames)))
+         for trackName in trackNames:
+            info = album[trackName]
+            values = [Intern(trackName)]
+            values.extend(Intern(info.get(attr)) for attr in kStringAttributes)
+            values.append(info.get("bitrate") or 0)
+            values.append(Time(info.get("acquired")))
+            values.append(Time(info.get("moved")))
+            tracks.append(kTrackRecord.pack(*values))
+
+   encoded = [s.encode("utf-8") for s in strings]
+   stringTable = []
+   blobOffset = 0
+   for s in encoded:
+      stringTable.append(kStringRecord.pack(blobOffset, len(s)))
+      blobOffset += len(s)
+
+   stringsAt = kHeader.size
+   albumsAt = stringsAt + kStringRecord.size * len(strings)
+   tracksAt = albumsAt + kAlbumRecord.size * len(albums)
+   blobAt = tracksAt + kTrackRecord.size * len(tracks)
+   tempPath = path + ".tmp"
+   with open(tempPath, "wb") as f:
+      f.write(kHeader.pack(kMagic, len(strings), stringsAt, len(albums),
+         albumsAt, len(tracks), tracksAt, blobAt))
+      f.write("".join(stringTable))
+      f.write("".join(albums))
+      f.write("".join(tracks))
+      f.write("".join(encoded))
+   os.rename(tempPath, path)
+
+
+class LibraryIndex(object):
+   def __init__(self, path):
+      '''
+      >>> import tempfile
+      >>> lib = {u'Kneebody': {u'2008_Low-Electrical-Worker': {
+      ...   '__mtime': 12.5,
+      ...   u'04_Dr-Beauchef': {'title': u'Dr. Beauchef', 'bitrate': 192,
+      ...      'acquired': 100, 'moved': 200, 'trackArtist': u''}}},
+      ...   u'Beatles': {u'1965_Rubber-Soul': {u'01_Drive-My-Car': {
+      ...      'title': u'Drive My Car', 'acquired': None}}}}
+      >>> path = tempfile.mktemp(kIndexExtension)
+      >>> WriteIndex(lib, path)
+      >>> idx = LibraryIndex(path)
+      >>> idx.Artists()
+      [u'Beatles', u'Kneebody']
+      >>> idx.Album(u'Kneebody', u'2008_Low-Electrical-Worker')[u'04_Dr-Beauchef']['bitrate']
+      192
+      >>> idx.Album(u'Kneebody', u'nope') is None
+      True
+      >>> idx.ToLibrary()[u'Kneebody'] == lib[u'Kneebody']
+      True
+      >>> idx.ToLibrary()[u'Beatles'][u'1965_Rubber-Soul'][u'01_Drive-My-Car']['acquired'] is None
+      True
+      >>> idx.TrackCount([u'Kneebody'])
+      1
+      >>> idx.Close()
+      >>> os.remove(path)
+      '''
+      self.path = path
+      self.file = open(path, "rb")
+      self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+      (magic, self.stringCount, self.stringsAt, self.albumCount, self.albumsAt,
+         self.trackCount, self.tracksAt, self.blobAt) = kHeader.unpack_from(self.data, 0)
+      if magic != kMagic:
+         raise IndexFormatError("{0} isn't a library index file".format(path))
+      self._albumKeys = None
+
+   def Close(self):
+      self.data.close()
+      self.file.close()
+
+   def String(self, stringId):
+      if stringId == kNone:
+         return None
+      offset, length = kStringRecord.unpack_from(self.data,
+         self.stringsAt + stringId * kStringRecord.size)
+      start = self.blobAt + offset
+      return self.data[start:start + length].decode("utf-8")
+
+   def _AlbumRecord(self, i):
+      return kAlbumRecord.unpack_from(self.data, self.albumsAt + i * kAlbumRecord.size)
+
+   def _AlbumKeys(self):
+      ''' list of (artist, album) names for all albums, in file order (which
+         is sorted.) Only the album table gets read to build this.
+      '''
+      if self._albumKeys is None:
+         self._albumKeys = []
+         for i in range(self.albumCount):
+            artistId, albumId = self._AlbumRecord(i)[:2]
+            self._albumKeys.append((self.String(artistId), self.String(albumId)))
+      return self._albumKeys
+
+   def Artists(self):
+      ''' sorted list of artist names. '''
+      return sorted(set(artist for (artist, album) in self._AlbumKeys()))
+
+   def Albums(self, artist):
+      ''' sorted list of album names for an artist. '''
+      keys = self._AlbumKeys()
+      i = bisect.bisect_left(keys, (artist, u""))
+      albums = []
+      while i < len(keys) and keys[i][0] == artist:
+         albums.append(keys[i][1])
+         i += 1
+      return albums
+
+   def _FindAlbum(self, artist, album):
+      keys = self._AlbumKeys()
+      i = bisect.bisect_left(keys, (artist, album))
+      if i < len(keys) and keys[i] == (artist, album):
+         return i
+      return None
+
+   def Track(self, trackNum):
+      ''' return (trackName, trackInfo dict) for a row in the track table. '''
+      values = kTrackRecord.unpack_from(self.data,
+         self.tracksAt + trackNum * kTrackRecord.size)
+      stringIds = values[1:1 + len(kStringAttributes)]
+      bitrate, acquired, moved = values[1 + len(kStringAttributes):]
+      info = dict((attr, self.String(i))
+         for (attr, i) in zip(kStringAttributes, stringIds) if i != kNone)
+      info["bitrate"] = bitrate
+      info["acquired"] = None if acquired == kNoTime else acquired
+      info["moved"] = None if moved == kNoTime else moved
+      return self.String(values[0]), info
+
+   def Album(self, artist, album):
+      ''' return the dict of tracks on an album (in the same layout that
+         ScanLibrary uses), or None if we don't know that album.
+      '''
+      i = self._FindAlbum(artist, album)
+      if i is None:
+         return None
+      _, _, mtime, firstTrack, trackCount = self._AlbumRecord(i)
+      retval = {kLastModified: mtime}
+      for trackNum in range(firstTrack, firstTrack + trackCount):
+         name, info = self.Track(trackNum)
+         retval[name] = info
+      return retval
+
+   def TrackCount(self, subdirs=None):
+      ''' Same as ScanLibrary.Scanner.TrackCount(), but only reads the album
+         table.
+      '''
+      if not subdirs:
+         return self.trackCount
+      count = 0
+      for subdir in subdirs:
+         parts = [p for p in subdir.split("/") if p]
+         if len(parts) > 1:
+            albums = [parts[1]]
+         else:
+            albums = self.Albums(parts[0])
+         for album in albums:
+            i = self._FindAlbum(parts[0], album)
+            if i is not None:
+               count += self._AlbumRecord(i)[4]
+      return count
+
+   def ToLibrary(self):
+      ''' inflate the whole index into the nested dict layout. '''
+      library = {}
+      for (artist, album) in self._AlbumKeys():
+         library.setdefault(artist, {})[album] = self.Album(artist, album)
+      return library
+
+
+if __name__ == "__main__":
+   import argparse
+   import json
+   import sys
+   parser = argparse.ArgumentParser("Convert library files between JSON and binary index formats.")
+   parser.add_argument("-t", "--test", action='store_true',
+      help ="run unit tests (other options ignored)")
+   parser.add_argument("src", nargs="?", help="file to convert")
+   parser.add_argument("dest", nargs="?", help="file to write")
+
+   args = parser.parse_args()
+   if args.test:
+      import doctest
+      print "running module tests."
+      doctest.testmod()
+      print "done."
+      sys.exit(0)
+
+   if not (args.src and args.dest):
+      parser.error("need both a src and a dest file")
+
+   if IsIndexFile(args.src):
+      index = LibraryIndex(args.src)
+      with open(args.dest, "wt") as f:
+         f.write(json.dumps(index.ToLibrary(), sort_keys=True,
+            indent=4, separators=(',', ': ')))
+      index.Close()
+   else:
+      with open(args.src, "rt") as f:
+         WriteIndex(json.loads(f.read()), args.dest)
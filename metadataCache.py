@@ -0,0 +1,181 @@
+'''
+   Persistent cache of the metadata that fileDestination.Mp3File derives
+   from each MP3 file (and of the audio hashes that dupeFinder.py computes.)
+
+   Parsing ID3 tags (and reading the stream info to get the bitrate and
+   length) for every file in a big library is slow, especially across the
+   network. We keep the derived values in a SQLite database (usually at the
+   top of the library) keyed by the absolute path to the file (so it doesn't
+   matter how, or from where, a program named the file), and only trust an 
+   entry if the file's size and modification time are the same as when we 
+   stored it.
+'''
+
+import os
+import sqlite3
+import threading
+
+kCacheFileName = u".mp3meta.db"
+
+# the Mp3File attributes that we store.
+kCachedFields = ("albumArtist", "trackArtist", "album", "year", "discNumber",
+   "trackNum", "title", "genre", "bitrate", "length", "compilation")
+
+# commit to disk after this many new entries.
+kCommitInterval = 500
+
+kSchema = '''CREATE TABLE IF NOT EXISTS tracks (
+   path TEXT PRIMARY KEY,
+   size INTEGER,
+   mtime REAL,
+   {0}
+);
+CREATE TABLE IF NOT EXISTS audioHashes (
+   path TEXT PRIMARY KEY,
+   size INTEGER,
+   mtime REAL,
+   digest TEXT
+);'''.format(",\n   ".join(kCachedFields))
+
+
+def CachePath(libraryRoot):
+   ''' return the default location of the cache file for a library.
+   >>> CachePath(u'/music')
+   u'/music/.mp3meta.db'
+   '''
+   return os.path.join(libraryRoot, kCacheFileName)
+
+
+def _Key(path):
+   ''' the key we store a file's entries under.
+   >>> _Key('/music/a/../b.mp3')
+   u'/music/b.mp3'
+   >>> _Key(u'b.mp3') == os.path.join(os.getcwdu(), u'b.mp3')
+   True
+   '''
+   if isinstance(path, str):
+      path = path.decode("utf-8")
+   return os.path.abspath(path)
+
+
+class MetadataCache(object):
+   def __init__(self, dbPath):
+      '''
+      >>> c = MetadataCache(':memory:')
+      >>> c.Put(u'/a/b.mp3', 100, 12.5, {'title': u'Bee', 'bitrate': 128})
+      >>> c.Get(u'/a/b.mp3', 100, 12.5)['title']
+      u'Bee'
+      >>> c.Get(u'/a/b.mp3', 101, 12.5) is None
+      True
+      >>> c.Get(u'/a/c/../b.mp3', 100, 12.5)['title']
+      u'Bee'
+      >>> c.Close()
+      '''
+      self.dbPath = dbPath
+      # Mp3File objects may be created on worker threads (see workerPool), so
+      # we share a single connection and serialize access to it ourselves.
+      self.lock = threading.Lock()
+      self.db = sqlite3.connect(dbPath, check_same_thread=False)
+      self.db.row_factory = sqlite3.Row
+      self.db.executescript(kSchema)
+      self.PruneRelative()
+      self.uncommitted = 0
+      # how many Get() calls we could and couldn't answer, for Summary()
+      self.hits = 0
+      self.misses = 0
+
+   def PruneRelative(self):
+      ''' Delete any entries stored under relative paths, which earlier 
+         versions of this module wrote and which we'd never look up again.
+      >>> c = MetadataCache(':memory:')
+      >>> c.db.execute("INSERT INTO tracks (path, size, mtime) VALUES ('a/b.mp3', 1, 1)") and None
+      >>> c.PruneRelative()
+      1
+      >>> c.Close()
+      '''
+      stale = 0
+      with self.lock:
+         for table in ("tracks", "audioHashes"):
+            paths = [row[0] for row in self.db.execute(
+               "SELECT path FROM {0}".format(table)) if not os.path.isabs(row[0])]
+            self.db.executemany("DELETE FROM {0} WHERE path=?".format(table), 
+               [(path,) for path in paths])
+            stale += len(paths)
+         if stale:
+            self.db.commit()
+      return stale
+
+   def Get(self, path, size, mtime):
+      ''' Return a dict of cached field values for this file, or None if we
+         don't have it (or the file has changed since we cached it.)
+      '''
+      with self.lock:
+         row = self.db.execute("SELECT * FROM tracks WHERE path=?",
+            (_Key(path),)).fetchone()
+         if row is None or row["size"] != size or row["mtime"] != mtime:
+            self.misses += 1
+            return None
+         self.hits += 1
+      return dict((field, row[field]) for field in kCachedFields)
+
+   def Put(self, path, size, mtime, fields):
+      ''' store (or replace) the entry for this file. '''
+      values = [_Key(path), size, mtime]
+      values.extend(fields.get(field) for field in kCachedFields)
+      placeholders = ",".join("?" * len(values))
+      with self.lock:
+         self.db.execute("INSERT OR REPLACE INTO tracks VALUES ({0})".format(
+            placeholders), values)
+         self.uncommitted += 1
+         if self.uncommitted >= kCommitInterval:
+            self.db.commit()
+            self.uncommitted = 0
+
+   def GetHash(self, path, size, mtime):
+      ''' Return the cached hash of the audio data in this file (see 
+         dupeFinder.py), or None if we don't have one that's still valid.
+      >>> c = MetadataCache(':memory:')
+      >>> c.PutHash(u'/a/b.mp3', 100, 12.5, 'abc123')
+      >>> c.GetHash(u'/a/b.mp3', 100, 12.5)
+      u'abc123'
+      >>> c.GetHash(u'/a/b.mp3', 100, 13.0) is None
+      True
+      '''
+      with self.lock:
+         row = self.db.execute("SELECT * FROM audioHashes WHERE path=?",
+            (_Key(path),)).fetchone()
+      if row is None or row["size"] != size or row["mtime"] != mtime:
+         return None
+      return row["digest"]
+
+   def PutHash(self, path, size, mtime, digest):
+      with self.lock:
+         self.db.execute("INSERT OR REPLACE INTO audioHashes VALUES (?,?,?,?)",
+            (_Key(path), size, mtime, digest))
+         self.uncommitted += 1
+         if self.uncommitted >= kCommitInterval:
+            self.db.commit()
+            self.uncommitted = 0
+
+   def Summary(self):
+      ''' e.g. "1200 of 1250 files from the metadata cache (96.0%)" 
+      >>> c = MetadataCache(':memory:')
+      >>> c.Put(u'/a/b.mp3', 100, 12.5, {'title': u'Bee'})
+      >>> c.Get(u'/a/b.mp3', 100, 12.5) and c.Get(u'/a/c.mp3', 100, 12.5)
+      >>> c.Summary()
+      '1 of 2 files from the metadata cache (50.0%)'
+      '''
+      lookups = self.hits + self.misses
+      return "{0} of {1} files from the metadata cache ({2:.1%})".format(
+         self.hits, lookups, float(self.hits) / lookups if lookups else 0)
+
+   def Close(self):
+      with self.lock:
+         self.db.commit()
+         self.db.close()
+
+
+
+if __name__ == "__main__":
+   import doctest
+   doctest.testmod()
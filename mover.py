@@ -4,11 +4,23 @@
 Requires that you have the mutagen ID parsing library installed.
 '''
 
+import itertools
 import os
+import threading
 
 
+import ScanLibrary
 import fileSource
+import copyEngine
+import encoders
 import fileDestination
+import historyIndex
+import libraryIndex
+import readAhead
+import metadataCache
+import transferJournal
+import transferPlan
+import workerPool
 
 
 
@@ -27,6 +39,45 @@ def ErrorLog(s):
       f.write("{0}\n".format(s))   
 
 
+class Progress(object):
+   ''' Callable that we hand to the FileDestination object; it's called once 
+      for each music file as we finish with it. When we're transcoding in 
+      parallel, files finish some time after they've been handed off, so 
+      we can't just count them in the main loop.
+
+      We start copying before we know how many files there are in total, so
+      `fileCount` may be None for a while.
+   '''
+   def __init__(self, fileCount=None):
+      self.fileCount = fileCount
+      self.mp3FileNum = 0
+
+   def __call__(self, path, success=True):
+      self.mp3FileNum += 1
+      if self.fileCount:
+         percentDone = float(self.mp3FileNum) / self.fileCount
+         print "{1}/{2} files ({0:.2%}) complete".format(percentDone, 
+            self.mp3FileNum, self.fileCount)
+      else:
+         print "{0}/? files complete".format(self.mp3FileNum)
+
+
+class MusicCounter(threading.Thread):
+   ''' Counts the music files in a FileSource on a background thread so that we 
+      can start copying files right away, and only report percentages once we 
+      know the total. (Call run() instead of start() to count them right now.)
+   '''
+   def __init__(self, source, progress):
+      super(MusicCounter, self).__init__()
+      self.daemon = True
+      self.source = source
+      self.progress = progress
+
+   def run(self):
+      count = sum(1 for (fileType, fName) in self.source 
+         if fileSource.kMusic == fileType)
+      self.progress.fileCount = count
+      print "Found {0} music files.".format(count)
 
 
 
@@ -45,7 +96,8 @@ if __name__ == "__main__":
    parser.add_argument("-s", "--src", action="store", nargs="?",
       default=os.getcwd(), help="Source directory containing mp3 files")
    parser.add_argument("-d", "--dest", action="store", nargs="?",
-      default=kTargetBasePath, help="Destination directory for mp3 files")
+      default=None, help="Destination directory for mp3 files (default: {0})".format(
+         kTargetBasePath))
    parser.add_argument("-m", "--mode", action="store", nargs="?",
       default = "copy", choices=["debug", "copy", "move"], 
       help = "Move/copy/debug")
@@ -55,8 +107,33 @@ if __name__ == "__main__":
       help="Only move/copy music files; skip .jpg, etc.")
    parser.add_argument('-c', '--cleanup', action="store_true", 
       help="Remove directories left empty after moving files")
-
-
+   parser.add_argument("-k", "--cache", action="store", nargs="?", const="",
+      default=None, 
+      help="Use a metadata cache file (default: {0} in `src')".format(
+         metadataCache.kCacheFileName))
+   parser.add_argument("-y", "--historyindex", action="store_true",
+      help="Keep the history index at the top of `dest' up to date")
+   parser.add_argument("-S", "--stream", action="store_true",
+      help="Pipe files through LAME and tag them afterwards so that all of their tags are kept (copy only)")
+   parser.add_argument("-j", "--jobs", action="store", nargs="?", type=int,
+      default=1, help="Number of transcodes to run at once (copy only)")
+
+
+   parser.add_argument("-x", "--index", action="store", nargs="?",
+      default="", 
+      help="Library file from ScanLibrary to get the file count from instead of counting")
+   parser.add_argument("-a", "--readahead", action="store", nargs="?", type=int,
+      const=readAhead.kDefaultDepth, default=0, 
+      help="Read tags (and data, when copying) up to this many files ahead of the ones being written (default: {0})".format(
+         readAhead.kDefaultDepth))
+   parser.add_argument("-R", "--resume", action="store_true",
+      help="Skip files that an interrupted earlier run already handled")
+   parser.add_argument("-p", "--plan", action="store", nargs="?",
+      default="", 
+      help="Don't move/copy anything; write a plan of what we'd do to this file")
+   parser.add_argument("-e", "--execute-plan", action="store", nargs="?",
+      default="", 
+      help="Carry out a plan written with --plan (src, mode, rate, etc. come from the plan)")
    parser.add_argument("-i", "--input", action="store", nargs="?",
       default="", 
       help="Input file containing directores to handle (1 per line, relative to `src')" )
@@ -70,6 +147,12 @@ if __name__ == "__main__":
       print "running module tests."
       doctest.testmod(fileSource)
       doctest.testmod(fileDestination)
+      doctest.testmod(workerPool)
+      doctest.testmod(transferPlan)
+      doctest.testmod(transferJournal)
+      doctest.testmod(encoders)
+      doctest.testmod(copyEngine)
+      doctest.testmod(readAhead)
       print "done."
       sys.exit(0)
 
@@ -90,6 +173,10 @@ if __name__ == "__main__":
 
    source = fileSource.FileSource(unicode(args.src), others)
 
+   if args.cache is not None:
+      cachePath = args.cache or metadataCache.CachePath(unicode(args.src))
+      fileDestination.UseMetadataCache(cachePath)
+
    # ...then prepare the destination handler object.
    mode = args.mode
    debug = False
@@ -97,32 +184,138 @@ if __name__ == "__main__":
       debug = True 
       mode = 'copy'
 
+   plan = None
+   if args.execute_plan:
+      # everything about how to handle the files comes from the plan.
+      plan = transferPlan.PlanReader(args.execute_plan)
+      settings = plan.settings
+      destDir = unicode(args.dest or settings["baseDir"])
+      mode = settings["mode"]
+      rate = u"{0}{1}".format("V" if settings["vbr"] else "", settings["rate"])
+      dest = fileDestination.FileDestination(destDir, mode, settings["onDupe"], 
+         rate, settings["musicOnly"], settings["cleanUp"], debug, args.jobs,
+         args.stream)
+   else:
+      destDir = unicode(args.dest or kTargetBasePath)
+      dest = fileDestination.FileDestination(destDir, mode, args.dupe, 
+         args.rate, args.musiconly, args.cleanup, debug, args.jobs,
+         args.stream)
+
+   if args.plan:
+      # just work out what we'd do and how long it would take.
+      writer = transferPlan.PlanWriter(args.plan, dest)
+      for (fileType, fName) in source:
+         try:
+            writer.Add(fileType, fName)
+         except fileDestination.MetadataException as e:
+            print "ERROR: {0}".format(str(e))
+      writer.Close()
+      fileDestination.CloseMetadataCache()
+      print "Plan written to {0}:".format(args.plan)
+      print writer.estimate
+      sys.exit(0)
 
+   # keep a journal of what we've done (unless we're not really doing anything)
+   # so that if this run gets interrupted, it can be resumed.
+   if not debug:
+      dest.journal = transferJournal.Journal(transferJournal.JournalPath(destDir), 
+         args.resume)
+
+   histIndex = None
+   if args.historyindex and not debug:
+      histIndex = historyIndex.HistoryIndex(destDir)
+      histIndex.Attach()
+
+   # We don't walk the whole source up front -- we start copying right away 
+   # and get the total number of files either from a library index or by 
+   # counting them on another thread while we work (unless we're moving.)
+   progress = Progress()
+   dest.onMusicDone = progress
+   if plan:
+      progress.fileCount = plan.MusicCount()
+      events = plan.Events()
+   else:
+      events = ((fileType, fName, None) for (fileType, fName) in source)
+      if args.index:
+         if libraryIndex.IsIndexFile(args.index):
+            # we can count from a binary index without loading all of it.
+            libIndex = libraryIndex.LibraryIndex(args.index)
+            progress.fileCount = libIndex.TrackCount(others)
+            libIndex.Close()
+         else:
+            progress.fileCount = ScanLibrary.Scanner(args.src, args.index).TrackCount(others)
+         print "Library index lists {0} music files.".format(progress.fileCount)
+      else:
+         counter = MusicCounter(fileSource.FileSource(unicode(args.src), others), progress)
+         if "move" == mode:
+            # we'll be moving files (and maybe removing the directories they 
+            # leave empty) out from under the counter's walk of the same 
+            # tree, so count everything before we start instead.
+            counter.run()
+         else:
+            counter.start()
+
+   # With read-ahead, a background thread reads tags and file data while we 
+   # write. The two take turns on any device they share.
+   limiter = None
+   if args.readahead:
+      limiter = readAhead.DeviceLimiter()
+      events = readAhead.ReadAhead(events, dest, args.readahead, 
+         "copy" == mode and not debug, limiter)
+      destDevice = readAhead.Device(destDir)
+
+   # Hold on to anything that comes before the first music file; if there 
+   # aren't any music files at all, there's nothing to do.
+   leading = []
+   for event in events:
+      leading.append(event)
+      if fileSource.kMusic == event[0]:
+         break
+   else:
+      leading = None
 
-   dest = fileDestination.FileDestination(unicode(args.dest), mode, args.dupe, 
-      args.rate, args.musiconly, args.cleanup, debug)
-
-
-   toHandle = list(source)
-   fileCount = sum(1 for item in toHandle if item[0] == fileSource.kMusic)
-
-   if fileCount:
-      print "{0} {1} files.".format("copying" if "copy" == mode else "moving", fileCount)
+   if leading:
+      print "{0} files.".format("copying" if "copy" == mode else "moving")
       # and finally perform the move/copy:
-      mp3FileNum = 0
-      for (fileType, fName) in toHandle:
+      for (fileType, fName, mp3) in itertools.chain(leading, events):
          try:
-            dest.HandleFile(fileType, fName)
+            if limiter:
+               with limiter.Hold(destDevice):
+                  dest.HandleFile(fileType, fName, mp3)
+            else:
+               dest.HandleFile(fileType, fName, mp3)
          except fileDestination.MetadataException as e:
             print "ERROR: {0}".format(str(e))
-         if fileSource.kMusic == fileType:
-            mp3FileNum += 1
-            percentDone = float(mp3FileNum) / fileCount
-            print "{1}/{2} files ({0:.2%}) complete".format(percentDone, mp3FileNum, fileCount)
+            dest.failures.append((fName, str(e)))
+            progress(fName)
+      # wait for any transcodes that are still running.
+      dest.Finish()
+      print ", ".join("{0} {1}".format(count, action) for (action, count) 
+         in sorted(dest.summary.items()))
+      if dest.copier.counts:
+         print "Copied/moved with: {0}".format(dest.copier.Summary())
+      if fileDestination.mp3Cache:
+         print fileDestination.mp3Cache.Summary()
+      if dest.resumed:
+         print "{0} file(s) were already done by an earlier run.".format(dest.resumed)
+      if dest.failures:
+         print "{0} file(s) failed:".format(len(dest.failures))
+         for (fName, error) in dest.failures:
+            print "   {0}: {1}".format(fName.encode("utf-8"), error)
       print "Done."         
    else:
       print "Nothing to do."
 
+   fileDestination.CloseMetadataCache()
+   if histIndex:
+      histIndex.Close()
+   if dest.journal:
+      if dest.failures:
+         # keep it so that a run with --resume can retry just the failures.
+         dest.journal.Close()
+      else:
+         dest.journal.Remove()
+
 
 
 
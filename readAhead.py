@@ -0,0 +1,148 @@
+'''
+   Overlap the reading side of a mover run with the writing side.
+
+   Normally mover.py handles one file at a time: read its tags, then copy
+   it, then read the next one's tags... so the source drive sits idle while
+   we write and the destination sits idle while we read. ReadAhead runs the
+   read stage (parsing the tags of each music file, and optionally reading
+   its data so that it's in the OS cache when we go to copy it) on a
+   background thread, handing the events to the write stage through a
+   bounded queue. The write stage still gets every event in the original
+   order, so progress reporting and directory cleanup work just as they do
+   without it.
+
+   A DeviceLimiter keeps the two stages from hitting the same drive at once
+   (which makes a slow USB drive thrash), while letting them run in parallel
+   when the source and destination are on different devices.
+'''
+
+import os
+import Queue
+import sys
+import threading
+
+import fileDestination
+import fileSource
+
+kDefaultDepth = 16
+
+kReadSize = 1024 * 1024
+
+
+def Device(path):
+   ''' the device that `path` is on (or would be, if it doesn't exist yet.)
+   >>> Device(u'/no/such/place') == os.stat(u'/').st_dev
+   True
+   '''
+   path = os.path.abspath(path)
+   while True:
+      try:
+         return os.stat(path).st_dev
+      except OSError:
+         parent = os.path.dirname(path)
+         if parent == path:
+            raise
+         path = parent
+
+
+class DeviceLimiter(object):
+   def __init__(self, limit=1):
+      ''' limit -- how many threads may be working on each device at once.
+
+      >>> limiter = DeviceLimiter()
+      >>> limiter.Hold(1) is limiter.Hold(1), limiter.Hold(1) is limiter.Hold(2)
+      (True, False)
+      '''
+      self.limit = limit
+      self.lock = threading.Lock()
+      self.semaphores = {}
+
+   def Hold(self, device):
+      ''' return a semaphore for the device to use in a `with` statement. '''
+      with self.lock:
+         if device not in self.semaphores:
+            self.semaphores[device] = threading.BoundedSemaphore(self.limit)
+         return self.semaphores[device]
+
+
+class _Failure(object):
+   ''' an exception raised in the read stage, on its way to the write stage. '''
+   def __init__(self, excInfo):
+      self.excInfo = excInfo
+
+
+class ReadAhead(object):
+   def __init__(self, events, dest, depth=kDefaultDepth, prefetch=False,
+         limiter=None):
+      '''
+         events -- iterable of (fileType, path, mp3) tuples, where mp3 may be
+            None (we'll parse the tags for music files that don't have one.)
+         dest -- the FileDestination the events are going to.
+         depth -- how many events we let the read stage get ahead by.
+         prefetch -- if True, also read the data of each music file.
+         limiter -- a DeviceLimiter shared with the write stage.
+
+      >>> dest = fileDestination.FileDestination(u'/tmp', "copy")
+      >>> events = [(fileSource.kDirectory, u'/a', None),
+      ...    (fileSource.kExitDirectory, u'/a', None)]
+      >>> list(ReadAhead(iter(events), dest, depth=1)) == events
+      True
+      '''
+      self.events = events
+      self.dest = dest
+      self.prefetch = prefetch
+      self.limiter = limiter or DeviceLimiter()
+      self.queue = Queue.Queue(depth)
+      self.thread = threading.Thread(target=self._Read)
+      # if the write stage gives up, don't let us keep the process alive.
+      self.thread.daemon = True
+      self.thread.start()
+
+   def _Parse(self, path):
+      ''' the read stage's work on one music file. Returns an Mp3File, or None
+         if there's nothing for us to do (or we couldn't parse it -- we let the
+         write stage run into the error again so it gets reported as usual.)
+      '''
+      st = os.stat(path)
+      journal = self.dest.journal
+      if journal and journal.Completed(path, st.st_size, st.st_mtime):
+         return None
+      with self.limiter.Hold(st.st_dev):
+         try:
+            mp3 = fileDestination.Mp3File(path)
+         except fileDestination.MetadataException:
+            return None
+         if self.prefetch:
+            with open(path, "rb") as f:
+               while f.read(kReadSize):
+                  pass
+      return mp3
+
+   def _Read(self):
+      try:
+         for (fileType, path, mp3) in self.events:
+            if fileSource.kMusic == fileType and mp3 is None:
+               try:
+                  mp3 = self._Parse(path)
+               except (IOError, OSError):
+                  mp3 = None
+            self.queue.put((fileType, path, mp3))
+      except Exception:
+         # hand the problem to the write stage.
+         self.queue.put(_Failure(sys.exc_info()))
+         return
+      self.queue.put(None)
+
+   def __iter__(self):
+      while True:
+         item = self.queue.get()
+         if item is None:
+            return
+         if isinstance(item, _Failure):
+            raise item.excInfo[0], item.excInfo[1], item.excInfo[2]
+         yield item
+
+
+if __name__ == "__main__":
+   import doctest
+   doctest.testmod()
@@ -27,7 +27,9 @@ import datetime
 import glob
 import time
 
+import ScanLibrary
 import fileSource
+import historyIndex
 import trackHistory
 from trackHistory import History
 
@@ -64,6 +66,11 @@ if __name__ == "__main__":
       default=kPlaylistDir, help="output directory for playlist files.")
    parser.add_argument("-p", "--periods", action="store", nargs="?", 
       default="7,30,90,180", help="list of most recent 'n' days of files to gather")
+   parser.add_argument("-y", "--historyindex", action="store_true",
+      help="Use (and update) the history index at the top of `src' instead of loading every history file")
+   parser.add_argument("-i", "--index", action="store", nargs="?",
+      default="", 
+      help="Use the Recent index saved with this ScanLibrary library file instead of walking `src'")
 
    args = parser.parse_args()
    args = vars(args)
@@ -77,21 +84,41 @@ if __name__ == "__main__":
 
    srcPath = args['src']
 
-   fs = fileSource.FileSource(srcPath)
-
-   for (t, p) in fs:
-      if fileSource.kDirectory == t:
-         try: # !!! delete this after testing...
-            history = History(p)
-         except: 
-            print "!!!! EXCEPTION LOADING HISTORY FILE !!!"
-            print p
-            print "!!!!"
-            continue
-         if history.fileExists:
-            for i, cutoff in enumerate(cutoffs):
-               tracks = history.RecentTracks(cutoff)
-               if tracks:
+   if args['index']:
+      # everything we need is in the index -- no need to look at the library.
+      recent = ScanLibrary.Recent()
+      recent.LoadFile(ScanLibrary.RecentPath(args['index']))
+      trackLists = [recent.TrackPaths(cutoff) for cutoff in cutoffs]
+   elif args['historyindex']:
+      # only history files that changed since the last run get loaded.
+      index = historyIndex.HistoryIndex(unicode(srcPath))
+      index.Sync()
+      trackLists = [index.TracksAfter(cutoff) for cutoff in cutoffs]
+      index.Close()
+   else:
+      fs = fileSource.FileSource(srcPath)
+      oldestCutoff = min(cutoffs)
+
+      for (t, p) in fs:
+         if fileSource.kDirectory == t:
+            # A history file gets rewritten whenever a track is added to it, so 
+            # if it hasn't been modified since our oldest cutoff, none of its 
+            # tracks can be recent enough and we don't need to read it.
+            try:
+               if os.stat(trackHistory.HistoryFilePath(p)).st_mtime < oldestCutoff:
+                  continue
+            except OSError:
+               # no history file here.
+               continue
+            try: # !!! delete this after testing...
+               history = History(p)
+            except: 
+               print "!!!! EXCEPTION LOADING HISTORY FILE !!!"
+               print p
+               print "!!!!"
+               continue
+            if history.fileExists:
+               for i, tracks in enumerate(history.RecentTracksMulti(cutoffs)):
                   trackLists[i].extend(tracks)
 
    for days, trackList in zip(periods, trackLists):
@@ -0,0 +1,143 @@
+'''
+   Weighted random sampling with limits, for shuffler.py.
+
+   Each item gets a random key of u ** (1 / weight) for a uniform random u
+   (Efraimidis & Spirakis); the items with the k largest keys are a weighted
+   random sample of k items without replacement. We make a heap of the keys
+   (which takes O(n)) and pop items off it in order (O(log n) each), skipping
+   any that would go over one of our caps (e.g. no more than 3 tracks from
+   any one album), until we have k of them or run out of items.
+'''
+
+import collections
+import heapq
+import math
+import os
+import random
+import time
+
+import trackHistory
+
+# how long it takes (in seconds) for a track's recency boost to fall by half.
+kHalfLife = 180 * 24 * 60 * 60
+
+
+def RecencyWeight(acquired, boost, now=None, halfLife=kHalfLife):
+   ''' Weight for a track acquired at `acquired` (a time.time() value, or
+      None if we don't know): a track acquired just now is (1 + boost) times
+      as likely to be picked as one that's been around forever.
+   >>> RecencyWeight(None, 3)
+   1.0
+   >>> RecencyWeight(1000, 3, now=1000)
+   4.0
+   >>> RecencyWeight(1000, 3, now=1000 + kHalfLife)
+   2.5
+   '''
+   if acquired is None or not boost:
+      return 1.0
+   if now is None:
+      now = time.time()
+   age = max(0, now - acquired)
+   return 1.0 + boost * 2 ** (-float(age) / halfLife)
+
+
+def AcquisitionDates(paths, histIndex=None):
+   ''' {path : acquisition date (or None)} for a list of track paths. If we're
+      given a historyIndex.HistoryIndex for the library, we look them up in 
+      it; any tracks that aren't in it come from their album's history file 
+      (each of which we read only once.)
+   '''
+   indexed = histIndex.Dates(trackHistory.kAcqDate) if histIndex else {}
+   histories = {}
+   retval = {}
+   for path in paths:
+      date = indexed.get(os.path.abspath(path))
+      if date is not None:
+         retval[path] = date
+         continue
+      albumDir, trackName = os.path.split(path)
+      if albumDir not in histories:
+         histories[albumDir] = trackHistory.History(albumDir)
+      retval[path] = histories[albumDir].GetTrack(trackName)[trackHistory.kAcqDate]
+   return retval
+
+
+class Sampler(object):
+   def __init__(self, seed=None):
+      '''
+         seed -- seed for the random numbers, so a run can be repeated.
+
+      >>> s = Sampler(seed=1)
+      >>> items = [(artist, album) for artist in "ab" for album in "xyz"]
+      >>> s.AddCap(lambda item: item[0], 2)
+      >>> picked = s.Sample(items, 10)
+      >>> len(picked), sorted(set(artist for (artist, album) in picked))
+      (4, ['a', 'b'])
+      >>> Sampler(seed=5).Sample(range(100), 5) == Sampler(seed=5).Sample(range(100), 5)
+      True
+      >>> Sampler(seed=5).Sample(range(10), 3, lambda i: 1 if i == 7 else 0)
+      [7]
+      '''
+      self.random = random.Random(seed)
+      # [(keyFunc, cap, Counter)]
+      self.caps = []
+
+   def AddCap(self, keyFunc, cap, counts=None):
+      ''' Allow at most `cap` picked items with the same keyFunc(item). counts
+         is a collections.Counter of how many there already are for each key
+         (e.g. tracks that are already on the destination.)
+      '''
+      if counts is None:
+         counts = collections.Counter()
+      self.caps.append((keyFunc, cap, counts))
+
+   def _Fits(self, item):
+      for (keyFunc, cap, counts) in self.caps:
+         if counts[keyFunc(item)] >= cap:
+            return False
+      return True
+
+   def Sample(self, items, k, weight=None, size=None, budget=None):
+      ''' Return a list of up to k of `items` picked at random, where each
+         item's chance is proportional to weight(item) (items with a weight of
+         zero are never picked.) The list is in the order that they were
+         picked; it's shorter than k if we ran out of items that fit.
+
+         If we're given a budget, we also stop picking items once the total 
+         of size(item) for the items we've picked would go over it. Any item 
+         that's too big for what's left of the budget is passed over for 
+         smaller ones, so we fill the budget as well as we can.
+      >>> picked = Sampler(seed=3).Sample(range(10), 10, 
+      ...    size=lambda i: 100 if i == 0 else 10, budget=35)
+      >>> len(picked), 0 in picked
+      (3, False)
+      '''
+      heap = []
+      for (i, item) in enumerate(items):
+         w = weight(item) if weight else 1.0
+         if w > 0:
+            # log(u ** (1/w)), negated to turn heapq's min-heap into a max-heap.
+            # (1 - random() is in (0, 1], so the log is always defined.)
+            heap.append((-math.log(1.0 - self.random.random()) / w, i))
+      heapq.heapify(heap)
+
+      picked = []
+      while heap and len(picked) < k:
+         key, i = heapq.heappop(heap)
+         item = items[i]
+         if budget is not None:
+            itemSize = size(item)
+            if itemSize > budget:
+               continue
+         if self._Fits(item):
+            if budget is not None:
+               budget -= itemSize
+            picked.append(item)
+            for (keyFunc, cap, counts) in self.caps:
+               counts[keyFunc(item)] += 1
+      return picked
+
+
+if __name__ == "__main__":
+   import doctest
+   doctest.testmod()
@@ -1,8 +1,16 @@
+import collections
+import itertools
 import os
 import random
+import sqlite3
 
+import candidateIndex
+import destManifest
 import fileSource
 import fileDestination
+import historyIndex
+import metadataCache
+import sampler
 import trackHistory
 
 kTargetBasePath = '/media/usb1/'
@@ -15,41 +23,134 @@ kMaxFiles = 5000
 # each time we run, we cycle in this many new files.
 kRefreshCount = 500
 
+# space that we leave free on the destination (for history files, directory
+# entries, and guessing wrong about how big a transcoded file will be.)
+kReserveBytes = 4 * 1024 * 1024
 
+kMegabyte = 1024.0 * 1024
 
-def DeleteTrack(trackFile):
+
+
+def DeleteTrack(trackFile, manifest=None):
    ''' trackFile is the full path to the track we want to delete. Delete the file 
-      (if it exists) and also remove it from a history file if it's there. 
+      (if it exists) and also remove it from a history file (and the 
+      destination manifest, if we're given one) if it's there. 
 
       If deleting this file leaves empty album and artist directories, remove them 
       as we exit.
    '''
-   print "deleting file {0}".format(destFile.encode('utf-8'))
-   path, track = os.path.split(trackFile)
-   history = trackHistory.History(path)
-   os.remove(trackFile)
-   try:
-      history.RemoveTrack(track)
+   DeleteTracks([trackFile], manifest)
+
+
+def DeleteTracks(trackFiles, manifest=None):
+   ''' Delete a list of tracks like DeleteTrack() does, an album at a time, so
+      that each album's history file only gets rewritten once and we only 
+      check once whether the album & artist directories are now empty.
+   '''
+   for (path, albumFiles) in itertools.groupby(sorted(trackFiles), os.path.dirname):
+      history = trackHistory.History(path)
+      for trackFile in albumFiles:
+         print "deleting file {0}".format(trackFile.encode('utf-8'))
+         track = os.path.basename(trackFile)
+         os.remove(trackFile)
+         if manifest:
+            manifest.Remove(trackFile)
+         try:
+            history.RemoveTrack(track)
+         except trackHistory.RemoveTrackError:
+            print "ERROR deleting track {0}".format(track.encode('utf-8'))
       history.Save()
-   except trackHistory.RemoveTrackError:
-      print "ERROR deleting track {0}".format(track.encode('utf-8'))
-
-   # see if we need to trim empty directories
-   # peel off the file name first.
-   pth1, pth2 = os.path.split(destFile)
-   print "checking {0} for deletion...".format(pth1.encode('utf-8'))
-   if not os.listdir(pth1):
-      # empty, so delete the album directory.
-      print 'Deleting empty directory {0}'.format(pth1.encode('utf-8'))
-      os.rmdir(pth1)
-      # see if we can also delete the artist directory
-      pth1, pth2 = os.path.split(pth1)
-      if not os.listdir(pth1):
-         # yep, the artist dir is empty. Get rid of it.
-         print 'Deleting empty directory {0}'.format(pth1.encode('utf-8'))
-         os.rmdir(pth1)
+
+      # see if we need to trim empty directories
+      print "checking {0} for deletion...".format(path.encode('utf-8'))
+      if not os.listdir(path):
+         # empty, so delete the album directory.
+         print 'Deleting empty directory {0}'.format(path.encode('utf-8'))
+         os.rmdir(path)
+         # see if we can also delete the artist directory
+         path = os.path.dirname(path)
+         if not os.listdir(path):
+            # yep, the artist dir is empty. Get rid of it.
+            print 'Deleting empty directory {0}'.format(path.encode('utf-8'))
+            os.rmdir(path)
+
+
+class Copier(object):
+   ''' Hands tracks to a FileDestination (which may be transcoding several of 
+      them at once on a pool of worker threads) and records each one in the 
+      destination manifest once it's actually been written.
+   '''
+   def __init__(self, dest, index, manifest):
+      self.dest = dest
+      self.index = index
+      self.manifest = manifest
+      # {source file : (destination path, predicted size)} for each track that
+      # we've handed to dest and that it hasn't finished with yet.
+      self.inFlight = {}
+      dest.onMusicDone = self.Done
+
+   def PendingBytes(self):
+      return sum(size for (destPath, size) in self.inFlight.values())
+
+   def Copy(self, srcFile):
+      ''' Start copying a track to the destination. Returns False if there 
+         isn't room for it.
+      '''
+      candidate = self.index.Find(srcFile)
+      if candidate:
+         destPath, size, mp3 = (candidate.destPath, 
+            self.index.PredictedSize(candidate), candidate.Mp3())
+      else:
+         destPath, size, mp3 = os.path.abspath(self.dest.MusicLocation(srcFile)), 0, None
+      # count the files that are still being written, too.
+      if not RoomFor(size + self.PendingBytes(), self.dest.baseDir):
+         return False
+      self.inFlight[srcFile] = (destPath, size)
+      try:
+         self.dest.HandleMusic(srcFile, mp3)
+      except fileDestination.MetadataException as e:
+         print "ERROR: {0}".format(str(e))
+         self.inFlight.pop(srcFile, None)
+      return True
+
+   def Done(self, srcFile, success):
+      ''' called by dest when it's finished with a track. '''
+      destPath, size = self.inFlight.pop(srcFile)
+      if success:
+         AddToManifest(self.manifest, destPath, srcFile)
+      elif os.path.exists(destPath):
+         # don't leave a partly written track behind for the next run to 
+         # mistake for a good one.
+         print "Removing failed copy {0}".format(destPath.encode('utf-8'))
+         os.remove(destPath)
+
+   def Finish(self):
+      ''' wait for everything to be written. '''
+      self.dest.Finish()
+
+
+def RoomFor(size, destDir):
+   ''' Check that there's room on the destination for a file of (about) 
+      `size` bytes, plus a little extra for directories and history files, so 
+      we stop cleanly instead of running out of space partway through a file.
+   '''
+   free = destManifest.FreeBytes(destDir)
+   if size + kReserveBytes > free:
+      print "Stopping: only {0:.1f} MB free on {1}".format(free / kMegabyte, 
+         destDir.encode("utf-8"))
+      return False
+   return True
 
 
+def AddToManifest(manifest, destPath, srcPath):
+   ''' record a track we just copied in the destination manifest (if it 
+      actually made it there.)
+   '''
+   try:
+      manifest.Add(destPath, os.path.getsize(destPath), srcPath)
+   except OSError:
+      pass
+
 
 def FilterTrack(trackFile):
    ''' Decide whether this track should be copied over or not, based 
@@ -61,12 +162,30 @@ def FilterTrack(trackFile):
    retval = False
 
    mp3 = fileDestination.Mp3File(trackFile)
-   if mp3.length < (9 * 60):
+   if mp3.length < candidateIndex.kMaxLength:
       if mp3.genre in kGenres:
          retval = True
    return retval
 
 
+def ParseSize(s):
+   ''' convert a size like '500M' or '7.5G' to a number of bytes.
+   >>> ParseSize("1000")
+   1000
+   >>> ParseSize("1.5k")
+   1536
+   >>> ParseSize("7G")
+   7516192768
+   '''
+   kUnits = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+   s = s.strip().lower().rstrip("b")
+   multiplier = 1
+   if s and s[-1] in kUnits:
+      multiplier = kUnits[s[-1]]
+      s = s[:-1]
+   return int(float(s) * multiplier)
+
+
 def GetMusicFiles(fSource):
    ''' fSource is a fileSource.FileSource object. Returns a list of all the Mp3
       files contained in that source.
@@ -92,13 +211,32 @@ if __name__ == "__main__":
       default="0", help="Transcode bitrate (copy only). Use V[0..9] for VBR")
    parser.add_argument("-m", "--max", action="store", nargs="?", type=int, 
       default=kMaxFiles, help="Maximum number of files on the destination")
+   parser.add_argument("-c", "--capacity", action="store", nargs="?", type=ParseSize,
+      default=None, help="Fill the destination up to this many bytes (e.g. 7.5G) as well as limiting the number of files")
    parser.add_argument('-n', "--new", action="store", nargs="?", type=int, 
       default=kRefreshCount, help="Number of new files to shuffle in")
    parser.add_argument('-a', '--add', action="store", nargs="?",
        help="path to directory holding files to add")
+   parser.add_argument("-k", "--cache", action="store", nargs="?", const="",
+      default="", 
+      help="Metadata cache file to use (default: {0} in `src')".format(
+         metadataCache.kCacheFileName))
+   parser.add_argument("-K", "--nocache", action="store_true",
+      help="Don't use a metadata cache (every source file's tags get read)")
    parser.add_argument("-p", "--pinned", action="store", nargs="?",
       default="", 
       help="Input file containing directores to force onto the drive (1 per line, relative to `src')" )   
+   parser.add_argument("-w", "--recent", action="store", nargs="?", type=float,
+      default=0, const=3, 
+      help="Favor recently acquired tracks: a brand new track is 1 + RECENT times as likely to be picked (default with no value: 3)")
+   parser.add_argument("-l", "--albumcap", action="store", nargs="?", type=int,
+      default=None, help="Most tracks from any one album to have on the destination")
+   parser.add_argument("-i", "--artistcap", action="store", nargs="?", type=int,
+      default=None, help="Most tracks by any one artist to have on the destination")
+   parser.add_argument("-j", "--jobs", action="store", nargs="?", type=int,
+      default=1, help="Number of transcodes to run at once")
+   parser.add_argument("-e", "--seed", action="store", nargs="?", type=int,
+      default=None, help="Random number seed, to make a run repeatable")
 
 
    args = parser.parse_args()
@@ -107,13 +245,29 @@ if __name__ == "__main__":
       import doctest
       print "running module tests..."
       doctest.testmod()
+      doctest.testmod(candidateIndex)
+      doctest.testmod(sampler)
+      doctest.testmod(destManifest)
       print "done."
       sys.exit(0)
 
-   # get an inventory of all the files that are already on the destination
-   destSource = fileSource.FileSource(args.dest)
+   args.src = unicode(args.src)
+   args.dest = unicode(args.dest)
+
+   # we look at the tags of every track in the library each time we run, so 
+   # unless we're told not to, keep them in a cache and only read the tags 
+   # of files that are new or have changed.
+   if not args.nocache:
+      try:
+         fileDestination.UseMetadataCache(args.cache or metadataCache.CachePath(args.src))
+      except sqlite3.Error as e:
+         print "WARNING: not using a metadata cache: {0}".format(e)
+
+   # get an inventory of all the files that are already on the destination,
+   # from its manifest if we can trust it.
    print "Getting list of files at destination {0}".format(args.dest)
-   destInventory = GetMusicFiles(destSource) 
+   manifest = destManifest.Open(args.dest)
+   destInventory = manifest.Paths()
 
    # get a list of the files that we want to have pinned on the dest
    if args.pinned:
@@ -131,17 +285,29 @@ if __name__ == "__main__":
 
    toCopy = []
    doNotDelete = []
-   dest = fileDestination.FileDestination(args.dest, "copy", "skip", args.rate, True)
+   dest = fileDestination.FileDestination(args.dest, "copy", "skip", args.rate, True,
+      jobs=args.jobs)
+
+   # read the tags of every source file once, so that picking files later on 
+   # doesn't need to touch them again.
+   print "Reading tags of {0} source files".format(len(srcFiles))
+   index = candidateIndex.CandidateIndex(dest).Build(srcFiles)
+   if fileDestination.mp3Cache:
+      print fileDestination.mp3Cache.Summary()
+   present = set(destInventory)
 
    for f in pinnedFiles:
       # we add each pinned file to one of two lists -- either we need to copy 
       # this file to the destination (list toCopy), or it's already pinned there,
       # so we need to add it to the list of files that shouldn't be deleted
-      # (list doNotDelete). The fileDestination::MusicLocation() method
-      # figures out where the source file is supposed to live, and we check to see 
-      # if it's already there or not.  
-      destPath = dest.MusicLocation(f)
-      if not os.path.exists(destPath):
+      # (list doNotDelete). The candidate index knows where the source file is
+      # supposed to live, and we check to see if it's already there or not.  
+      candidate = index.Find(f)
+      if candidate:
+         destPath = candidate.destPath
+      else:
+         destPath = os.path.abspath(dest.MusicLocation(f))
+      if destPath not in present:
          toCopy.append(f)
       else:
          doNotDelete.append(destPath)
@@ -151,6 +317,7 @@ if __name__ == "__main__":
    if args.add:
       addSrc = fileSource.FileSource(args.add)
       addFiles = GetMusicFiles(addSrc)
+      index.Build(addFiles)
 
    toCopy.extend(addFiles)
 
@@ -159,6 +326,7 @@ if __name__ == "__main__":
    # (because it's already there, and we need to know to not delete it below.)
    
    doNotDelete = set(doNotDelete)
+   deleted = set()
    destFileCount = len(destInventory)
    pinnedCopyFileCount = len(toCopy)
    availableRoom = args.max - destFileCount
@@ -189,20 +357,49 @@ if __name__ == "__main__":
       # there's more room than we need -- use it all up.
       newFileCount = availableRoom
 
-   print "About to delete {0} files from {1}".format(deleteCount, args.dest)
+   # If we're filling the destination up to a number of bytes, we may also
+   # need to delete files to make enough room for the new files -- and we 
+   # can only guess how big they'll be once they've been transcoded.
+   deleteBytes = 0
+   if args.capacity:
+      if dest.MusicHandler == dest._DoTranscode:
+         dest.SelectEncoder()
+      usedBytes = sum(manifest.Size(f) for f in destInventory)
+      pinnedBytes = sum(index.PredictedSize(c) for c in 
+         (index.Find(f) for f in toCopy) if c)
+      eligibleSizes = [index.PredictedSize(index[i]) for i in 
+         index.Filter(kGenres, exclude=present)]
+      averageSize = sum(eligibleSizes) / max(1, len(eligibleSizes))
+      deleteBytes = max(0, pinnedBytes + args.new * averageSize - 
+         (args.capacity - usedBytes))
+      print "{0:.1f} of {1:.1f} MB in use; need about {2:.1f} MB for new files".format(
+         usedBytes / kMegabyte, args.capacity / kMegabyte, 
+         (pinnedBytes + args.new * averageSize) / kMegabyte)
+
+   # randomly pick files at the destination to delete (enough to make room 
+   # for the new ones), leaving alone the ones that are protected by being 
+   # pinned.
+   deletable = [f for f in destInventory if f not in doNotDelete]
+   random.Random(args.seed).shuffle(deletable)
+   deleteFiles = []
+   freedBytes = 0
+   for destFile in deletable:
+      if len(deleteFiles) >= deleteCount and freedBytes >= deleteBytes:
+         break
+      deleteFiles.append(destFile)
+      freedBytes += manifest.Size(destFile)
+   deleteFiles.sort()
+
+   print "About to delete {0} files ({1:.1f} MB) from {2}".format(len(deleteFiles), 
+      freedBytes / kMegabyte, args.dest)
    response = raw_input("Enter to continue or q to quit. ")
    if 'q' == response.lower():
       sys.exit(0)
 
-   # get the files at the destination all mixed up and start randomly deleting files
-   # that aren't protected by being pinned.
-   if deleteCount > 0:
-      random.shuffle(destInventory)
-      deleteFiles = destInventory[:deleteCount]
-      deleteFiles.sort()
-      for destFile in deleteFiles:
-         if destFile not in doNotDelete:
-            DeleteTrack(destFile)
+   shuffle = sampler.Sampler(args.seed)
+
+   DeleteTracks(deleteFiles, manifest)
+   deleted.update(deleteFiles)
    # okay, now we do the opposite -- we need to
    # 1. Copy up any pinned files that aren't up there yet
    # 2. Shuffle the source files and start copying files up that aren't already
@@ -210,43 +407,79 @@ if __name__ == "__main__":
 
    print "About to copy files to {0}".format(args.dest)
 
+   copier = Copier(dest, index, manifest)
    toCopy.sort()
    for f in toCopy:
       print "Copying pinned/added file {0} ({1} to go...)".format(f.encode('utf-8'), newFileCount)
-      dest.HandleMusic(f)
+      if not copier.Copy(f):
+         break
+      candidate = index.Find(f)
+      present.add(candidate.destPath if candidate else 
+         os.path.abspath(dest.MusicLocation(f)))
       newFileCount -= 1
 
-   random.shuffle(srcFiles)
-   index = 0
-   shuffled = []
-   while newFileCount > 0:
-      nextFile = srcFiles[index]
-      index += 1
-      destPath = dest.MusicLocation(nextFile)
-      if not os.path.exists(destPath):
-         if FilterTrack(nextFile):
-            shuffled.append(nextFile)
-            newFileCount -= 1
-
-   shuffled.sort()
-   shuffleCount = len(shuffled)
-   for (i, nextFile) in enumerate(shuffled):
-
-      print "Copying {0} ({1} to go)".format(nextFile.encode('utf-8'), shuffleCount-i)
-      dest.HandleMusic(nextFile)
-
-
+   # pick the new files from the ones that pass our filters and aren't 
+   # already on the destination, within the per album/artist limits (which 
+   # count the tracks that are still on the destination.)
+   eligible = [index[i] for i in index.Filter(kGenres, exclude=present)]
+   remaining = present - deleted
+   if args.albumcap:
+      shuffle.AddCap(lambda c: os.path.dirname(c.destPath), args.albumcap,
+         collections.Counter(os.path.dirname(p) for p in remaining))
+   if args.artistcap:
+      shuffle.AddCap(lambda c: os.path.dirname(os.path.dirname(c.destPath)), 
+         args.artistcap, collections.Counter(os.path.dirname(os.path.dirname(p)) 
+            for p in remaining))
+   weight = None
+   if args.recent:
+      # the library's history index (see historyIndex.py) can tell us when 
+      # everything was acquired without opening every album's history file.
+      histIndex = None
+      if os.path.exists(historyIndex.IndexPath(args.src)):
+         histIndex = historyIndex.HistoryIndex(args.src)
+         histIndex.Sync()
+      acquired = sampler.AcquisitionDates([c.path for c in eligible], histIndex)
+      if histIndex:
+         histIndex.Close()
+      weight = lambda c: sampler.RecencyWeight(acquired[c.path], args.recent)
+   if args.capacity:
+      # fill whatever room is left, as long as we stay under the file limit.
+      # (pinned files that are still being transcoded aren't in the manifest 
+      # yet, but they count against both.)
+      budget = (args.capacity - sum(manifest.Size(f) for f in manifest.Paths()) -
+         copier.PendingBytes())
+      shuffled = shuffle.Sample(eligible, 
+         args.max - len(manifest) - len(copier.inFlight), weight,
+         index.PredictedSize, budget)
+      print "Shuffling in {0} files (about {1:.1f} MB)".format(len(shuffled), 
+         sum(index.PredictedSize(c) for c in shuffled) / kMegabyte)
+   else:
+      shuffled = shuffle.Sample(eligible, max(0, newFileCount), weight)
+      if len(shuffled) < newFileCount:
+         print "Only {0} source files are eligible to shuffle in.".format(len(shuffled))
 
+   shuffled.sort(key=lambda c: c.path)
+   shuffleCount = len(shuffled)
+   for (i, candidate) in enumerate(shuffled):
 
+      print "Copying {0} ({1} to go)".format(candidate.path.encode('utf-8'), shuffleCount-i)
+      if not copier.Copy(candidate.path):
+         break
 
+   # wait for the last transcodes & write out the history of the last album 
+   # we copied to, and then the manifest (which has to be the last thing we 
+   # change on the drive.)
+   copier.Finish()
+   manifest.Save()
 
 
 
 
-   
 
 
 
 
 
+   
 
+   fileDestination.CloseMetadataCache()
@@ -31,6 +31,10 @@ kOldHistoryExtension = ".history"
 # index into the list.
 kAcqDate, kMoveDate = (0, 1)
 
+# functions to call with each History object after it's saved (see 
+# historyIndex.HistoryIndex.Attach())
+saveHooks = []
+
 
 class RemoveTrackError(Exception):
    def __init__(self, trackFile):
@@ -46,6 +50,32 @@ def MakeHistoryFilename(f):
 def IsHistoryFile(f):
    return os.path.splitext(f)[1] in (kHistoryExtension, kOldHistoryExtension)
 
+def AtomicWrite(filePath, data):
+   ''' Write `data` to `filePath` by writing a temp file next to it and then
+      renaming that into place, so we never leave a half-written file behind
+      if we're interrupted.
+   '''
+   tempPath = filePath + ".tmp"
+   try:
+      with open(tempPath, "wb") as f:
+         f.write(data)
+      os.rename(tempPath, filePath)
+   except:
+      try:
+         os.remove(tempPath)
+      except OSError:
+         pass
+      raise
+
+
+def HistoryFilePath(path):
+   ''' return the path to the history file for the album directory `path`.
+   >>> HistoryFilePath(u'music/Kneebody/2008_Low')
+   u'music/Kneebody/2008_Low/2008_Low.tracks'
+   '''
+   albumName = os.path.split(path)[1]
+   return os.path.join(path, MakeHistoryFilename(albumName))
+
 
 class History(object):
    def __init__(self, path):
@@ -58,9 +88,8 @@ class History(object):
       # we always use the last path component as our file name
       artistPath, self.albumName = os.path.split(path)
       _, self.artistName = os.path.split(artistPath)
-      filename = MakeHistoryFilename(self.albumName)
 
-      self.filePath = os.path.join(path, filename)
+      self.filePath = HistoryFilePath(path)
       self.isDirty = False
       self.fileExists = False
 
@@ -82,9 +111,8 @@ class History(object):
       '''
       if self.isDirty:
          if self.history:
-            with open(self.filePath, "wt") as f:
-               output = json.dumps(self.history, indent=3, separators=[',', ': '])
-               f.write(output)
+            output = json.dumps(self.history, indent=3, separators=[',', ': '])
+            AtomicWrite(self.filePath, output)
          else:
             # we have an empty history dict -- delete the file if it exists.
             try:
@@ -93,6 +121,8 @@ class History(object):
                # that file isn't there, which is probably (?) not an error?
                print "***** ERROR trying to delete {0}".format(self.filePath.encode('utf-8'))
          self.isDirty = False
+         for hook in saveHooks:
+            hook(self)
 
    def GetTrack(self, trackFile):
       '''
@@ -156,14 +186,70 @@ class History(object):
 
       return retval
 
+   def RecentTracksMulti(self, cutoffs, dateType=kAcqDate):
+      ''' Like RecentTracks(), but for several cutoff dates at once. Returns a 
+         list with a list of tracks for each of the cutoffs, looking at each 
+         track only once.
+
+      >>> h = History(u'/nowhere/Artist/Album')
+      >>> h.AddTrack(u'01.mp3', 100)
+      >>> h.AddTrack(u'02.mp3', 200)
+      >>> h.AddTrack(u'03.mp3', 300)
+      >>> [sorted(t) for t in h.RecentTracksMulti([250, 150, 1000])]
+      [[u'Artist/Album/03.mp3'], [u'Artist/Album/02.mp3', u'Artist/Album/03.mp3'], []]
+      '''
+      if dateType not in (kAcqDate, kMoveDate):
+         raise ValueError("datetype must be in (kAcqDate, kMoveDate)")
 
+      retval = [[] for cutoff in cutoffs]
+      if not cutoffs:
+         return retval
 
+      self.PrepRecent()
+      if self.mostRecent[dateType] < min(cutoffs):
+         # nothing here is recent enough for any of the cutoffs.
+         return retval
+
+      # visit the cutoffs from oldest to newest; once a track is older than 
+      # one of them, it's older than all of the ones after it, too.
+      order = sorted(range(len(cutoffs)), key=lambda i: cutoffs[i])
+      for (track, dates) in self.history.items():
+         trackPath = os.path.join(self.artistName, self.albumName, track)
+         for i in order:
+            if dates[dateType] < cutoffs[i]:
+               break
+            retval[i].append(trackPath)
+      return retval
 
 
-
-
-
-
-
-
-
+class HistorySession(object):
+   ''' Keeps History objects loaded across a number of changes, so that when 
+      we add a whole album's worth of tracks, we read each history file once 
+      and write it once instead of once per track.
+
+   >>> session = HistorySession()
+   >>> h = session.Get(u'/nowhere/Artist/Album')
+   >>> h is session.Get(u'/nowhere/Artist/Album')
+   True
+   >>> session.Flush()
+   >>> h is session.Get(u'/nowhere/Artist/Album')
+   False
+   '''
+   def __init__(self):
+      self.histories = {}
+
+   def Get(self, path):
+      ''' return the History for the album directory at `path`, loading it 
+         if we haven't already.
+      '''
+      try:
+         return self.histories[path]
+      except KeyError:
+         history = self.histories[path] = History(path)
+         return history
+
+   def Flush(self):
+      ''' save any changes we've made and forget everything we've loaded. '''
+      for history in self.histories.values():
+         history.Save()
+      self.histories = {}
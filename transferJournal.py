@@ -0,0 +1,150 @@
+'''
+   A journal of the music files that a mover.py run has finished with, so
+   that a run that dies partway through (drive unplugged, LAME crashing...)
+   can be resumed without re-doing everything.
+
+   The journal is a text file of JSON objects, one per line:
+      {"begin": [src, dest]}                 written before we start a file
+      {"done": [src, dest, size, mtime]}     written once it (and its
+                                             history) have been written
+
+   When we resume, any file that was begun but never finished may have been
+   left half-written at its destination, so we delete it -- unless its source
+   is gone, which means a move got as far as deleting the source, and the
+   destination is now the only copy we have.
+'''
+
+import errno
+import json
+import os
+
+kJournalFileName = u".mover-journal"
+
+
+def JournalPath(destDir):
+   '''
+   >>> JournalPath(u'/Volumes/car')
+   u'/Volumes/car/.mover-journal'
+   '''
+   return os.path.join(destDir, kJournalFileName)
+
+
+class Journal(object):
+   def __init__(self, path, resume=False):
+      '''
+         path -- the journal file
+         resume -- if True, load the entries from an existing journal and keep
+            adding to it; otherwise we start over with an empty journal.
+
+      >>> import tempfile
+      >>> path = tempfile.mktemp()
+      >>> src, partial = tempfile.mktemp(".mp3"), tempfile.mktemp(".mp3")
+      >>> open(src, "wb").close(); open(partial, "wb").close()
+      >>> moved = tempfile.mktemp(".mp3")
+      >>> open(moved, "wb").close()
+      >>> j = Journal(path)
+      >>> j.Begin(u'/src/a.mp3', u'/dest/a.mp3')
+      >>> j.Done(u'/src/a.mp3', u'/dest/a.mp3', 100, 1.5)
+      >>> j.Begin(unicode(src), unicode(partial))
+      >>> j.Begin(u'/src/c.mp3', unicode(moved))
+      >>> j.Close()
+      >>> j = Journal(path, resume=True) # doctest: +ELLIPSIS
+      removing partially written file ....mp3
+      >>> os.path.exists(partial), os.path.exists(moved)
+      (False, True)
+      >>> j.Completed(u'/src/c.mp3', 0, os.stat(moved).st_mtime) == moved
+      True
+      >>> j.Completed(u'/src/a.mp3', 100, 1.5)
+      u'/dest/a.mp3'
+      >>> j.Completed(u'/src/a.mp3', 101, 1.5) is None
+      True
+      >>> j.Remove()
+      >>> os.path.exists(path)
+      False
+      >>> os.remove(moved); os.remove(src)
+      '''
+      self.path = path
+      # {(src, size, mtime) : dest}
+      self.completed = {}
+      # the destination may not have been created yet.
+      try:
+         os.makedirs(os.path.dirname(os.path.abspath(path)))
+      except OSError, e:
+         if e.errno != errno.EEXIST:
+            raise
+      if resume:
+         self.Load()
+      self.file = open(path, "at" if resume else "wt")
+
+   def Load(self):
+      ''' read the entries from an existing journal file and clean up after
+         anything that was interrupted.
+      '''
+      begun = {}
+      try:
+         with open(self.path, "rt") as f:
+            for line in f:
+               try:
+                  entry = json.loads(line)
+               except ValueError:
+                  # the last line may have been cut off when we died.
+                  continue
+               if "begin" in entry:
+                  src, dest = entry["begin"]
+                  begun[src] = dest
+               elif "done" in entry:
+                  src, dest, size, mtime = entry["done"]
+                  begun.pop(src, None)
+                  self.completed[(src, size, mtime)] = dest
+      except IOError:
+         # no journal yet, so there's nothing to resume.
+         pass
+
+      for (src, dest) in begun.items():
+         if not os.path.exists(dest):
+            continue
+         if os.path.exists(src):
+            print "removing partially written file {0}".format(dest.encode("utf-8"))
+            os.remove(dest)
+         else:
+            # nothing to compare against when the source comes back, so 
+            # just remember where it went.
+            st = os.stat(dest)
+            self.completed[(src, st.st_size, st.st_mtime)] = dest
+
+   def _Write(self, entry):
+      self.file.write(json.dumps(entry))
+      self.file.write("\n")
+      # make sure that this hits the disk in case we crash.
+      self.file.flush()
+
+   def Completed(self, src, size, mtime):
+      ''' if this source file has already been handled (and hasn't changed
+         since), return where it went, else None.
+      '''
+      return self.completed.get((src, size, mtime))
+
+   def Begin(self, src, dest):
+      self._Write({"begin": [src, dest]})
+
+   def Done(self, src, dest, size, mtime):
+      self.completed[(src, size, mtime)] = dest
+      self._Write({"done": [src, dest, size, mtime]})
+
+   def Close(self):
+      self.file.close()
+
+   def Remove(self):
+      ''' close and delete the journal, once a run has finished cleanly and 
+         there's nothing left to resume.
+      '''
+      self.Close()
+      try:
+         os.remove(self.path)
+      except OSError:
+         pass
+
+
+if __name__ == "__main__":
+   import doctest
+   doctest.testmod()
@@ -0,0 +1,141 @@
+'''
+   Transfer plans for mover.py.
+
+   Planning a move/copy means walking the source and reading the metadata of
+   every music file to work out where it's going -- which is most of the
+   slow part of a run. A plan saves the results of that work (every event
+   from the FileSource, with the destination, the action to take, and the
+   metadata for each music file) so it can be replayed later, possibly on a
+   different machine, without reading any tags.
+
+   Plan files are JSON, one object per line:
+   - a header with the FileDestination settings used to make the plan
+   - one line per FileSource event
+   - a summary line with the cost estimate for the whole plan.
+'''
+
+import json
+import os
+
+import fileSource
+import fileDestination
+
+kPlanVersion = 1
+
+# LAME encodes roughly this many seconds of audio per second on one core.
+kTranscodeSpeed = 20.0
+
+
+def EstimateSize(length, rate, vbr):
+   ''' Predict the size in bytes of `length` seconds of audio encoded at
+      `rate` (kbps, or a VBR quality level if `vbr` is True.)
+   >>> EstimateSize(60, 128, False)
+   960000
+   >>> EstimateSize(60, 2, True)
+   1425000
+   '''
+   if vbr:
+      rate = fileDestination.kVbrEquivalents[rate]
+   return int(length * rate * 1000 / 8)
+
+
+class Estimate(object):
+   ''' running totals of what a plan will cost to execute. '''
+   def __init__(self):
+      self.actions = {}
+      self.bytesToWrite = 0
+      self.transcodeSeconds = 0.0
+
+   def Add(self, action, size, length, rate, vbr):
+      self.actions[action] = self.actions.get(action, 0) + 1
+      if "transcode" == action:
+         self.bytesToWrite += EstimateSize(length, rate, vbr)
+         self.transcodeSeconds += length / kTranscodeSpeed
+      elif "skip" != action:
+         self.bytesToWrite += size
+
+   def ToDict(self):
+      return {"actions": self.actions, "bytesToWrite": self.bytesToWrite,
+         "transcodeSeconds": self.transcodeSeconds}
+
+   def __str__(self):
+      actions = ", ".join("{0} {1}".format(count, action) for (action, count)
+         in sorted(self.actions.items()))
+      return "{0}\n{1:.1f} MB to write, about {2:.0f} minutes of transcoding".format(
+         actions, self.bytesToWrite / (1024.0 * 1024), self.transcodeSeconds / 60)
+
+
+class PlanWriter(object):
+   def __init__(self, path, dest):
+      ''' path -- where to write the plan
+         dest -- the FileDestination object the plan is for.
+
+         All of the paths in the plan are absolute, so that it can be carried 
+         out from any directory (or on another machine that mounts the 
+         library and destination at the same places.)
+      '''
+      self.dest = dest
+      self.estimate = Estimate()
+      self.file = open(path, "wt")
+      self._Write({"version": kPlanVersion, "baseDir": os.path.abspath(dest.baseDir),
+         "mode": dest.mode, "onDupe": dest.onDupe, "rate": dest.rate,
+         "vbr": dest.vbr, "musicOnly": dest.musicOnly, "cleanUp": dest.cleanUp})
+
+   def _Write(self, obj):
+      self.file.write(json.dumps(obj, separators=(',', ':')))
+      self.file.write("\n")
+
+   def Add(self, fileType, path):
+      ''' add an event from a FileSource to the plan, working out what to do
+         with it if it's a music file.
+      '''
+      path = os.path.abspath(path)
+      entry = {"type": fileType, "src": path}
+      if fileSource.kMusic == fileType:
+         mp3 = fileDestination.Mp3File(path)
+         destFile = self.dest.MusicDestination(mp3)
+         action = self.dest.MusicAction(mp3, destFile)
+         size = os.path.getsize(path)
+         self.estimate.Add(action, size, mp3.length, self.dest.rate, self.dest.vbr)
+         entry.update({"dest": os.path.abspath(destFile), "action": action, "size": size,
+            "fields": mp3.Fields()})
+      self._Write(entry)
+
+   def Close(self):
+      self._Write({"summary": self.estimate.ToDict()})
+      self.file.close()
+
+
+class PlanReader(object):
+   def __init__(self, path):
+      self.path = path
+      with open(path, "rt") as f:
+         self.settings = json.loads(f.readline())
+      if self.settings.get("version") != kPlanVersion:
+         raise ValueError("{0} isn't a version {1} plan file".format(path, kPlanVersion))
+
+   def _Entries(self):
+      with open(self.path, "rt") as f:
+         f.readline()
+         for line in f:
+            entry = json.loads(line)
+            if "summary" not in entry:
+               yield entry
+
+   def MusicCount(self):
+      return sum(1 for entry in self._Entries() if fileSource.kMusic == entry["type"])
+
+   def Events(self):
+      ''' yield (fileType, path, mp3) tuples where mp3 is an Mp3File made from
+         the saved metadata for music files (and None for everything else.)
+      '''
+      for entry in self._Entries():
+         mp3 = None
+         if "fields" in entry:
+            mp3 = fileDestination.Mp3File.FromFields(entry["src"], entry["fields"])
+         yield (entry["type"], entry["src"], mp3)
+
+
+if __name__ == "__main__":
+   import doctest
+   doctest.testmod()
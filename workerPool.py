@@ -0,0 +1,89 @@
+'''
+   A small bounded pool of worker threads for the slow, mostly out-of-process
+   parts of moving music around (e.g. running LAME).
+
+   Work is handed to the pool with Submit(), along with a callback. The
+   callbacks are *always* called from the thread that calls Submit()/Collect()/
+   Drain() (never from a worker thread), and always in the same order that the
+   work was submitted, so the code they call into (history files, progress 
+   counters) can stay simple and single-threaded. That ordering only covers 
+   work that went through the pool: anything the caller does itself between 
+   Submit() calls is done before the callbacks of jobs that are still running.
+'''
+
+import collections
+
+from multiprocessing.pool import ThreadPool
+
+
+class WorkerPool(object):
+   def __init__(self, jobs, maxPending=None):
+      '''
+         jobs -- number of worker threads to run.
+         maxPending -- how many submitted jobs we allow to be outstanding before
+            Submit() blocks waiting for the oldest one to finish. Defaults to
+            twice the number of workers.
+
+      >>> p = WorkerPool(2)
+      >>> done = []
+      >>> for i in range(5):
+      ...    p.Submit(lambda x: x * 10, (i,), lambda result, error: done.append(result))
+      >>> p.Drain()
+      >>> done
+      [0, 10, 20, 30, 40]
+      >>> p.Submit(lambda: 1/0, (), lambda result, error: done.append(type(error).__name__))
+      >>> p.Close()
+      >>> done[-1]
+      'ZeroDivisionError'
+      '''
+      self.jobs = jobs
+      self.maxPending = maxPending or (2 * jobs)
+      self.pool = ThreadPool(jobs)
+      self.pending = collections.deque()
+
+   def Submit(self, func, args, onDone):
+      ''' Run func(*args) on a worker thread. When it's done, we'll call
+         onDone(result, error) where `error` is None on success, or the
+         exception that the worker raised (in which case `result` is None.)
+      '''
+      asyncResult = self.pool.apply_async(func, args)
+      self.pending.append((asyncResult, onDone))
+      # don't let the amount of queued work grow without bound.
+      while len(self.pending) > self.maxPending:
+         self._Finish()
+      self.Collect()
+
+   def _Finish(self):
+      ''' wait for the oldest pending job to complete and call its callback. '''
+      asyncResult, onDone = self.pending.popleft()
+      try:
+         result = asyncResult.get()
+         error = None
+      except Exception, e:
+         result = None
+         error = e
+      onDone(result, error)
+
+   def Collect(self):
+      ''' call the callbacks of any jobs that are done without blocking. We
+         stop at the first job that's still running so that the callbacks stay
+         in submission order.
+      '''
+      while self.pending and self.pending[0][0].ready():
+         self._Finish()
+
+   def Drain(self):
+      ''' block until all of the submitted work is done. '''
+      while self.pending:
+         self._Finish()
+
+   def Close(self):
+      ''' finish any outstanding work and shut down the worker threads. '''
+      self.Drain()
+      self.pool.close()
+      self.pool.join()
+
+
+if __name__ == "__main__":
+   import doctest
+   doctest.testmod()